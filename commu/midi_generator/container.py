@@ -1,7 +1,7 @@
 import json
 from fractions import Fraction
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from pydantic import BaseModel, validator
 
@@ -10,8 +10,22 @@ from commu.preprocessor.utils import constants
 from commu.preprocessor.utils.container import MidiMeta
 
 
+PRECISIONS = ("fp32", "int8", "bf16", "fp16")
+
+
 class ModelArguments(BaseModel):
     checkpoint_dir: str
+    precision: str = "fp32"
+    # decode step exported with commu.model.decode_step, loaded instead of the checkpoint
+    decode_step: Optional[str] = None
+    # decode step exported with commu.model.onnx_decode_step, run with onnxruntime instead of torch
+    onnx_decode_step: Optional[str] = None
+
+    @validator("precision")
+    def validate_precision(cls, value: str) -> str:
+        if value not in PRECISIONS:
+            raise ValueError(f"precision should be one of {PRECISIONS}")
+        return value
 
 
 class TransXlInputData(MidiMeta):
@@ -21,6 +35,8 @@ class TransXlInputData(MidiMeta):
     top_k: int
     temperature: float
     chord_progression: List[str]
+    # mask the pitches far from the pitch range and the velocities outside [min_velocity, max_velocity]
+    meta_constraints: bool = False
 
     @validator("chord_progression")
     def validate_chord_progression_length(cls, value: List[str], values: Dict[str, Any]) -> List[str]:
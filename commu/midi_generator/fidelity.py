@@ -0,0 +1,115 @@
+import argparse
+from dataclasses import dataclass
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+from commu.model.model import MemTransformerLM
+from commu.preprocessor.encoder import MetaEncoder, TOKEN_OFFSET, encoder_utils
+from commu.preprocessor.utils import constants
+from commu.preprocessor.utils.container import MidiMeta
+
+
+@dataclass
+class FidelityReport:
+    mean_kl: float
+    max_kl: float
+    top1_agreement: float
+    num_positions: int
+
+
+def fidelity_prompts() -> List[List[int]]:
+    """
+    fixed prompt set: one meta per track role, each followed by the same bar of A minor
+    """
+    event2word, _ = encoder_utils.mk_remi_map()
+    meta_encoder = MetaEncoder()
+    bar = [
+        TOKEN_OFFSET.BAR.value,
+        TOKEN_OFFSET.POSITION.value,
+        event2word["Chord_am"],
+    ]
+    for position, pitch in zip([0, 32, 64, 96], [57, 60, 64, 69]):
+        bar += [
+            TOKEN_OFFSET.POSITION.value + position,
+            TOKEN_OFFSET.NOTE_VELOCITY.value + 40,
+            TOKEN_OFFSET.PITCH.value + pitch,
+            TOKEN_OFFSET.NOTE_DURATION.value + 31,
+        ]
+    prompts = []
+    for track_role in constants.TRACK_ROLE_MAP:
+        midi_meta = MidiMeta(
+            bpm=120,
+            audio_key="aminor",
+            time_signature="4/4",
+            pitch_range="mid",
+            num_measures=8,
+            inst="acoustic_piano",
+            genre="newage",
+            min_velocity=60,
+            max_velocity=90,
+            track_role=track_role,
+            rhythm="standard",
+        )
+        prompts.append([0] + meta_encoder.encode(midi_meta) + bar)
+    return prompts
+
+
+def next_token_log_probs(model: MemTransformerLM, prompts: List[List[int]]) -> torch.Tensor:
+    device = next(model.parameters()).device
+    context = torch.tensor(prompts, dtype=torch.long, device=device).t()
+    with torch.no_grad():
+        logits, _ = model.forward_generate(context, mems=model.init_decode_memory(len(prompts)))
+    return F.log_softmax(logits.float(), dim=-1)
+
+
+def compare_next_token_distributions(
+        reference: MemTransformerLM,
+        candidate: MemTransformerLM,
+        prompts: List[List[int]],
+) -> FidelityReport:
+    """
+    compare the next-token distributions of two models at every position of the prompts
+    """
+    ref_log_probs = next_token_log_probs(reference, prompts)
+    cand_log_probs = next_token_log_probs(candidate, prompts)
+    kl = (ref_log_probs.exp() * (ref_log_probs - cand_log_probs)).sum(-1)
+    agreement = ref_log_probs.argmax(-1) == cand_log_probs.argmax(-1)
+    return FidelityReport(
+        mean_kl=kl.mean().item(),
+        max_kl=kl.max().item(),
+        top1_agreement=agreement.float().mean().item(),
+        num_positions=kl.numel(),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        type=str,
+        default="int8")
+    parser.add_argument(
+        "--max_kl",
+        dest="max_kl",
+        type=float,
+        default=0.05)
+    args = parser.parse_args()
+
+    reference = MidiGenerationPipeline({"checkpoint_dir": args.checkpoint_dir})
+    candidate = MidiGenerationPipeline({"checkpoint_dir": args.checkpoint_dir, "precision": args.precision})
+    report = compare_next_token_distributions(
+        reference.model_initialize_task.execute(),
+        candidate.model_initialize_task.execute(),
+        fidelity_prompts())
+    print(report)
+    if report.max_kl > args.max_kl:
+        raise SystemExit(f"{args.precision} model diverges from fp32: max KL {report.max_kl:.4f} > {args.max_kl}")
@@ -1,4 +1,7 @@
+from typing import Iterator, List, Tuple
+
 import torch
+from miditoolkit import Note
 
 from commu.midi_generator.container import ModelArguments
 from commu.midi_generator.model_initializer import ModelInitializeTask
@@ -19,5 +22,13 @@ class MidiGenerationPipeline:
             device=self.device
         )
         self.preprocess_task = PreprocessTask()
-        self.inference_task = InferenceTask(self.device)
-        self.postprocess_task = PostprocessTask()
\ No newline at end of file
+        # the onnxruntime backend decodes on numpy arrays
+        self.inference_task = InferenceTask(None if self.model_args.onnx_decode_step else self.device)
+        self.postprocess_task = PostprocessTask()
+
+    def stream_bars(self, encoded_meta: List[int]) -> Iterator[Tuple[int, List[Note]]]:
+        """
+        generate a single sequence with the inference task, yielding its notes bar by bar as they are decoded
+        """
+        tokens = self.inference_task.stream_tokens(encoded_meta)
+        return self.postprocess_task.decode_bars(tokens, encoded_meta)
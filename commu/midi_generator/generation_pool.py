@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing.pool import AsyncResult
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import yacs.config
+
+from commu.midi_generator.container import TransXlInputData
+from commu.midi_generator.midi_inferrer import InferenceTask
+from commu.midi_generator.sample_cache import model_fingerprint
+from commu.model.model import MemTransformerLM
+from commu.model.onnx_decoder import OnnxDecoder
+
+# encoded metas, their input data and candidates per meta, as taken by InferenceTask.execute_batch
+GenerationJob = Tuple[List[List[int]], List[TransXlInputData], Optional[int]]
+
+# inference task of a worker process, set up by _init_worker
+_worker_task: Optional[InferenceTask] = None
+
+
+def _init_worker(model: MemTransformerLM, inference_cfg: yacs.config.CfgNode, num_threads: int) -> None:
+    global _worker_task
+    torch.set_num_threads(num_threads)
+    _worker_task = InferenceTask(torch.device("cpu"))
+    _worker_task(model=model, input_data=None, inference_cfg=inference_cfg)
+
+
+def _run_job(job: GenerationJob) -> List[List[List[int]]]:
+    encoded_metas, input_data, num_candidates = job
+    return _worker_task.execute_batch(encoded_metas, input_data, num_candidates=num_candidates)
+
+
+class GenerationPool:
+    def __init__(
+        self,
+        model: MemTransformerLM,
+        inference_cfg: yacs.config.CfgNode,
+        num_workers: int,
+        num_threads: Optional[int] = None,
+    ):
+        """
+        CPU worker processes running generation jobs with a model loaded once, in the parent
+        workers are forked after the model is loaded: its weights are not copied but shared with the parent,
+        copy-on-write, or through the page cache when they are memory-mapped from a flat checkpoint
+        each worker runs `num_threads` intra-op threads, the cores are divided among the workers by default
+        """
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("the generation pool shares the model with forked workers, fork is not available")
+        if isinstance(model, OnnxDecoder):
+            raise ValueError("onnxruntime sessions do not survive a fork, use the checkpoint or the scripted decode step")
+        if next(model.parameters()).device.type != "cpu":
+            raise ValueError("the generation pool runs on CPU")
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        if inference_cfg.SAMPLING.seed >= 0 and inference_cfg.GENERATION.sample_cache_path:
+            # hashed once before the fork rather than by every worker
+            model_fingerprint(model)
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        context = multiprocessing.get_context("fork")
+        self._pool = context.Pool(num_workers, initializer=_init_worker, initargs=(model, inference_cfg, num_threads))
+
+    def submit(self, job: GenerationJob) -> AsyncResult:
+        return self._pool.apply_async(_run_job, (job,))
+
+    def map(self, jobs: List[GenerationJob]) -> List[List[List[List[int]]]]:
+        """
+        results of the jobs, in order, see InferenceTask.execute_batch
+        """
+        return self._pool.map(_run_job, jobs, chunksize=1)
+
+    def close(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+
+
+_GENERATION_POOLS: "weakref.WeakKeyDictionary[MemTransformerLM, Dict[Tuple[int, int, str], GenerationPool]]" = (
+    weakref.WeakKeyDictionary()
+)
+_GENERATION_POOLS_LOCK = threading.Lock()
+
+
+def get_generation_pool(
+    model: MemTransformerLM,
+    inference_cfg: yacs.config.CfgNode,
+    num_workers: int,
+    num_threads: Optional[int] = None,
+) -> GenerationPool:
+    """
+    process-wide generation pool of a model, forked on first use and kept for the next generations
+    workers keep the inference config they were forked with, a pool is forked for each config
+    """
+    with _GENERATION_POOLS_LOCK:
+        pools = _GENERATION_POOLS.setdefault(model, {})
+        key = (num_workers, num_threads, inference_cfg.dump())
+        if key not in pools:
+            pools[key] = GenerationPool(model, inference_cfg, num_workers, num_threads)
+        return pools[key]
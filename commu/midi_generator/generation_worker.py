@@ -0,0 +1,408 @@
+import argparse
+import collections
+import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import mido
+import torch
+import yacs.config
+
+from commu.logger import logger
+from commu.midi_generator.container import TransXlInputData
+from commu.midi_generator.info_preprocessor import PreprocessTask
+from commu.midi_generator.midi_inferrer import GenerationFailedError, InferenceTask, SequenceState
+from commu.midi_generator.sequence_postprocessor import PostprocessTask
+from commu.model.model import DecodeMemory, MemTransformerLM
+
+# environment variable holding the key that clients of serve authenticate with
+AUTHKEY_ENV = "COMMU_WORKER_AUTHKEY"
+
+
+@dataclass(eq=False)
+class GenerationRequest:
+    """
+    `input_data.num_generate` sequences of an encoded meta, answered through `future`
+    """
+    encoded_meta: List[int]
+    input_data: TransXlInputData
+    future: Future = field(default_factory=Future)
+    sequences: List[List[int]] = field(default_factory=list)
+    # candidates started so far, numbering their sampling generators, and candidates still in the batch
+    num_decoded: int = 0
+    num_active: int = 0
+    # key of the sequences in the sample cache, None without it
+    key: Optional[str] = None
+
+    @property
+    def num_missing(self) -> int:
+        return self.input_data.num_generate - len(self.sequences)
+
+
+class GenerationWorker:
+    def __init__(
+        self,
+        model: MemTransformerLM,
+        inference_cfg: yacs.config.CfgNode,
+        device: torch.device,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        num_candidates: Optional[int] = None,
+    ):
+        """
+        long-lived generation loop decoding the requests of concurrent callers in one ragged batch
+        candidates join the batch between two forward passes as soon as there is room, whatever the length of
+        the sequences already in it (see DecodeMemory.cat), and leave it as soon as they finish
+        a request is answered as soon as enough of its candidates are valid, failed ones are decoded again
+        an idle worker waits up to `max_wait_ms` after a first request for others to start the batch with
+        defaults are taken from SERVING and GENERATION.num_candidates of inference_cfg
+        """
+        if not isinstance(model, MemTransformerLM):
+            # checked upfront, exported decode steps would only fail once a ragged batch is decoded
+            raise ValueError(
+                "the generation worker needs MemTransformerLM, exported decode steps (decode_step, onnx_decode_step) "
+                "have no padding mask for its batches of sequences of different lengths"
+            )
+        self.inference_task = InferenceTask(device)
+        self.inference_task(model=model, input_data=None, inference_cfg=inference_cfg)
+        if max_batch_size is None:
+            max_batch_size = inference_cfg.SERVING.max_batch_size
+        if max_wait_ms is None:
+            max_wait_ms = inference_cfg.SERVING.max_wait_ms
+        if num_candidates is None:
+            num_candidates = inference_cfg.GENERATION.num_candidates
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_candidates = num_candidates
+
+        # None asks the worker to stop
+        self.requests: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        # requests taken from the queue that are not decoding, in order
+        self.waiting: Deque[GenerationRequest] = collections.deque()
+        self.states: List[SequenceState] = []
+        self.owners: List[GenerationRequest] = []
+        self.mems: Optional[DecodeMemory] = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="generation-worker", daemon=True)
+
+    def start(self) -> "GenerationWorker":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        requests submitted so far are still answered, later ones fail
+        """
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, encoded_meta: List[int], input_data: TransXlInputData) -> Future:
+        """
+        return a future of the generated sequences, as returned by InferenceTask.execute
+        sequences found in the sample cache are answered right away, without going through the worker
+        """
+        request = GenerationRequest(encoded_meta, input_data)
+        sample_cache = self.inference_task.sample_cache()
+        if sample_cache is not None:
+            request.key = self.inference_task.sample_key(input_data, self.num_candidates)
+            sequences = sample_cache.get(request.key)
+            if sequences is not None:
+                request.future.set_result(sequences)
+                return request.future
+        self.requests.put(request)
+        return request.future
+
+    def generate_midis(self, meta: Dict[str, Any]) -> List[mido.MidiFile]:
+        """
+        meta as taken by PreprocessTask, pre- and postprocessing run in the calling thread
+        """
+        preprocess_task = PreprocessTask()
+        encoded_meta = preprocess_task.excecute(dict(meta))
+        sequences = self.submit(encoded_meta, preprocess_task.input_data).result()
+        postprocess_task = PostprocessTask()
+        postprocess_task(input_data=preprocess_task.input_data)
+        return postprocess_task.execute_in_memory(
+            sequences=sequences, meta_info_len=preprocess_task.get_meta_info_length()
+        )
+
+    def num_required(self, request: GenerationRequest) -> int:
+        return max(self.num_candidates, request.num_missing)
+
+    def run(self) -> None:
+        with torch.no_grad():
+            while not self.stopped or self.states or self.waiting:
+                self.collect()
+                try:
+                    self.admit()
+                    if self.states:
+                        self.step()
+                except Exception as error:
+                    logger.error(f"Generation failed: {error}")
+                    self.fail(error)
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request.future.set_exception(RuntimeError("generation worker stopped"))
+
+    def collect(self) -> None:
+        """
+        move the queued requests to `waiting`
+        an idle worker blocks for a first request, then gives others max_wait to arrive while there is room
+        """
+        block = not self.states and not self.waiting
+        deadline = None
+        while not self.stopped:
+            try:
+                if block:
+                    request = self.requests.get()
+                elif deadline is not None and sum(map(self.num_required, self.waiting)) < self.max_batch_size:
+                    request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is None:
+                self.stopped = True
+                return
+            self.waiting.append(request)
+            if block:
+                block, deadline = False, time.monotonic() + self.max_wait
+
+    def admit(self) -> None:
+        """
+        start the candidates of the waiting requests, in order, while they fit in the batch
+        a request with more candidates than max_batch_size is decoded alone
+        """
+        admitted, positions = [], []
+        num_free = self.max_batch_size - len(self.states)
+        while self.waiting:
+            num_new = self.num_required(self.waiting[0])
+            if num_new > num_free and (self.states or admitted):
+                break
+            admitted.append(self.waiting.popleft())
+            positions += [len(admitted) - 1] * num_new
+            num_free -= num_new
+        if not admitted:
+            return
+
+        task = self.inference_task
+        try:
+            num_conditional_tokens = len(admitted[0].encoded_meta)
+            init_seqs, mems, logits = task.init_seqs_and_mems(
+                [request.encoded_meta for request in admitted], num_conditional_tokens
+            )
+        except Exception as error:
+            for request in admitted:
+                request.future.set_exception(error)
+            raise
+        mems.select_batch(positions)
+        logits = logits[positions]
+        states, owners = [], []
+        for pos in positions:
+            request = admitted[pos]
+            states.append(task.init_state(list(init_seqs[pos]), request.input_data, request.num_decoded))
+            owners.append(request)
+            request.num_decoded += 1
+            request.num_active += 1
+
+        # the step on the last conditional token, as in InferenceTask.decode_steps
+        sampled = []
+        for state, state_logits in zip(states, logits):
+            if task.next_input_token(state) is not None:
+                state.logits = state_logits
+                sampled.append(state)
+        task.sample_next_tokens(sampled)
+        self.join(states, owners, mems)
+
+    def join(self, states: List[SequenceState], owners: List[GenerationRequest], mems: DecodeMemory) -> None:
+        self.mems = mems if self.mems is None else DecodeMemory.cat([self.mems, mems])
+        self.states += states
+        self.owners += owners
+
+    def retire(self, request: GenerationRequest) -> None:
+        """
+        a candidate of the request left the batch
+        """
+        request.num_active -= 1
+        if request.future.done():
+            return
+        if request.num_missing <= 0:
+            sequences = request.sequences[:request.input_data.num_generate]
+            if request.key is not None:
+                self.inference_task.sample_cache().put(request.key, sequences)
+            request.future.set_result(sequences)
+        elif request.num_active == 0:
+            # not enough valid candidates, new ones are started first
+            self.waiting.appendleft(request)
+
+    def step(self) -> None:
+        """
+        one forward pass of the batch, see InferenceTask.decode_steps
+        a failed candidate that can be rolled back leaves the batch, then joins it again with its truncated memory
+        """
+        task = self.inference_task
+        keep, rolled_back = [], []
+        for batch_idx, (state, request) in enumerate(zip(self.states, self.owners)):
+            if not request.future.done():
+                if not state.pending_inputs:
+                    task.snapshot_bar(state)
+                    state.pending_inputs.extend(task.next_input_tokens(state))
+                if state.pending_inputs:
+                    keep.append(batch_idx)
+                    continue
+                seq = task.finish_sequence(state)
+                if seq is not None:
+                    request.sequences.append(seq)
+                else:
+                    num_dropped = task.roll_back(state)
+                    if num_dropped is not None:
+                        memory = self.mems.clone([batch_idx])
+                        memory.truncate(len(memory) - num_dropped)
+                        state.pending_inputs.extend(task.next_input_tokens(state))
+                        rolled_back.append((state, request, memory))
+                        continue
+            self.retire(request)
+
+        if len(keep) != len(self.states):
+            self.states = [self.states[batch_idx] for batch_idx in keep]
+            self.owners = [self.owners[batch_idx] for batch_idx in keep]
+            if keep:
+                self.mems.select_batch(keep)
+            else:
+                self.mems = None
+        for state, request, memory in rolled_back:
+            self.join([state], [request], memory)
+        if not self.states:
+            return
+
+        segment_len = min(len(state.pending_inputs) for state in self.states)
+        tokens = [[state.pending_inputs.popleft() for state in self.states] for _ in range(segment_len)]
+        logits, self.mems = task.calc_batch_logits_and_mems(tokens, self.mems)
+
+        sampled = []
+        for state, state_logits in zip(self.states, logits):
+            state.num_fed += segment_len
+            state.logits = state_logits
+            if state.sample_after_forward and not state.pending_inputs:
+                sampled.append(state)
+        task.sample_next_tokens(sampled)
+
+    def fail(self, error: Exception) -> None:
+        """
+        answer the requests of the batch with the error and start over from an empty batch
+        """
+        for request in self.owners:
+            if not request.future.done():
+                request.future.set_exception(error)
+        self.states, self.owners, self.mems = [], [], None
+
+
+def serve(worker: GenerationWorker, address: Tuple[str, int], authkey: bytes) -> None:
+    """
+    answer the generation requests of other processes on a local socket, one thread per connection
+    each message is a meta as taken by GenerationWorker.generate_midis, answered with the generated midis,
+    or with a GenerationFailedError
+    messages are pickled: anyone holding `authkey` can run code in the worker, it must be kept secret
+    """
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f"Generation worker listening on {address}")
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_answer, args=(worker, connection), daemon=True).start()
+
+
+def _answer(worker: GenerationWorker, connection: Connection) -> None:
+    with connection:
+        while True:
+            try:
+                meta = connection.recv()
+            except EOFError:
+                return
+            try:
+                reply = worker.generate_midis(meta)
+            except Exception as error:
+                reply = GenerationFailedError(f"{type(error).__name__}: {error}")
+            connection.send(reply)
+
+
+def request_midis(address: Tuple[str, int], authkey: bytes, meta: Dict[str, Any]) -> List[mido.MidiFile]:
+    """
+    client side of serve
+    """
+    with Client(address, authkey=authkey) as connection:
+        connection.send(meta)
+        reply = connection.recv()
+    if isinstance(reply, Exception):
+        raise reply
+    return reply
+
+
+if __name__ == "__main__":
+    from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        type=str,
+        default="fp32")
+    parser.add_argument(
+        "--host",
+        dest="host",
+        type=str,
+        default="localhost")
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=6106)
+    parser.add_argument(
+        "--authkey",
+        dest="authkey",
+        type=str,
+        default=os.environ.get(AUTHKEY_ENV))
+    parser.add_argument(
+        "--max_batch_size",
+        dest="max_batch_size",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--max_wait_ms",
+        dest="max_wait_ms",
+        type=float,
+        default=None)
+    parser.add_argument(
+        "--num_candidates",
+        dest="num_candidates",
+        type=int,
+        default=None)
+    args = parser.parse_args()
+    if args.authkey is None:
+        args.authkey = secrets.token_hex(16)
+        print(f"Generation worker authkey (set {AUTHKEY_ENV} to choose it): {args.authkey}")
+
+    pipeline = MidiGenerationPipeline({"checkpoint_dir": args.checkpoint_dir, "precision": args.precision})
+    model = pipeline.model_initialize_task.execute()
+    worker = GenerationWorker(
+        model,
+        pipeline.model_initialize_task.inference_cfg,
+        pipeline.device,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        num_candidates=args.num_candidates,
+    ).start()
+    serve(worker, (args.host, args.port), args.authkey.encode())
@@ -1,30 +1,42 @@
+import collections
 import math
-from typing import List, Tuple
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional, Tuple
 
-import numpy as np
-import torch
-import torch.nn.functional as F
 import yacs.config
+from tqdm import tqdm
 
 from commu.logger import logger
 from commu.midi_generator.container import TransXlInputData
-from commu.model.model import MemTransformerLM
+from commu.midi_generator.numpy_token_sampler import NumpyTokenSampler
+from commu.midi_generator.prefix_cache import get_prefix_cache
+from commu.midi_generator.sample_cache import SampleCache, get_sample_cache, model_fingerprint, sample_key
+from commu.midi_generator.token_grammar import TokenGrammar
 from commu.preprocessor.encoder import TOKEN_OFFSET
 from commu.preprocessor.utils.constants import DEFAULT_POSITION_RESOLUTION
 
+if TYPE_CHECKING:
+    import torch
+
+    from commu.model.model import DecodeMemory, MemTransformerLM
+
+
+class GenerationFailedError(Exception):
+    pass
+
 
 class TeacherForceTask:
     def __init__(self, input_data):
         self.input_data = input_data
-        self.next_tokens_forced = []
-        self.wrong_tokens = []
-        self.no_sequence_appended = False
+        self.next_tokens_forced = collections.deque()
         self.is_incomplete = input_data.num_measures % 4 != 0
         self.incomplete_filled = not self.is_incomplete
 
         self.chord_token, self.chord_position = input_data.chord_token_components.values()
         assert len(self.chord_token) == len(self.chord_position), "Wrong Chord Length"
         self.chord_length = len(self.chord_token)
+        # index of the next chord to write, chords before it are already taught
+        self.chord_index = 0
         self.inter_chord_flags = []
         for i in self.chord_position:
             if i == TOKEN_OFFSET.POSITION.value:
@@ -43,7 +55,7 @@ class TeacherForceTask:
         check if there any more chords to write
         if not, return False
         """
-        return bool(len(self.chord_token) * len(self.chord_position))
+        return self.chord_index < self.chord_length
 
     def check_length_fit(self):
         """
@@ -84,8 +96,8 @@ class TeacherForceTask:
             and self.incomplete_filled
             and not self.check_length_fit()
             and not self.check_position_fit(seq)
-            and seq[-1] == self.chord_position[0]
-            and self.inter_chord_flags[0]
+            and seq[-1] == self.chord_position[self.chord_index]
+            and self.inter_chord_flags[self.chord_index]
         )
         return is_first_position_chord or is_inter_position_chord
 
@@ -96,16 +108,18 @@ class TeacherForceTask:
         if not self.check_remnant_chord():
             return False
         is_position_passed = (
-            self.chord_position[0] < token < TOKEN_OFFSET.POSITION.value + DEFAULT_POSITION_RESOLUTION
+            self.chord_position[self.chord_index]
+            < token
+            < TOKEN_OFFSET.POSITION.value + DEFAULT_POSITION_RESOLUTION
             or token == TOKEN_OFFSET.BAR.value
         )
-        return self.inter_chord_flags[0] and is_position_passed
+        return self.inter_chord_flags[self.chord_index] and is_position_passed
 
-    def check_wrong_chord_token_generated(self, token):
+    def check_too_many_bars(self, num_bars):
         """
-        all chord tokens should be teacher forced
+        the sequence already has more bars than measures, it can only fail validation
         """
-        return TOKEN_OFFSET.CHORD_START.value <= token <= TOKEN_OFFSET.CHORD_END.value
+        return num_bars > int(math.ceil(self.input_data.num_measures))
 
     def check_wrong_eos_generated(self, token):
         return self.check_remnant_chord() and token == TOKEN_OFFSET.EOS.value
@@ -120,29 +134,32 @@ class TeacherForceTask:
         self.next_tokens_forced.append(int(TOKEN_OFFSET.POSITION.value))
 
     def teach_chord_token(self):
-        next_chord_tokens = self.chord_token.pop(0)
+        next_chord_tokens = self.chord_token[self.chord_index]
         self.next_tokens_forced.append(next_chord_tokens)
-        self.chord_position.pop(0)
-        self.inter_chord_flags.pop(0)
-        self.wrong_tokens = []
+        self.chord_index += 1
 
     def teach_chord_position(self):
-        next_position_token = self.chord_position[0]
+        next_position_token = self.chord_position[self.chord_index]
         self.next_tokens_forced.append(next_position_token)
-        self.wrong_tokens = []
-
-    def teach_wrong_chord_token(self, wrong_token):
-        self.no_sequence_appended = True
-        self.wrong_tokens.append(wrong_token)
 
     def teach_remnant_chord(self):
-        token = self.chord_position[0] if self.inter_chord_flags[0] else TOKEN_OFFSET.BAR.value
+        if self.inter_chord_flags[self.chord_index]:
+            token = self.chord_position[self.chord_index]
+        else:
+            token = TOKEN_OFFSET.BAR.value
         self.next_tokens_forced.append(token)
 
     def teach_eos(self):
         token = TOKEN_OFFSET.EOS.value
         self.next_tokens_forced.append(token)
 
+    def snapshot(self) -> Tuple[List[int], bool, int]:
+        return list(self.next_tokens_forced), self.incomplete_filled, self.chord_index
+
+    def restore(self, snapshot: Tuple[List[int], bool, int]) -> None:
+        next_tokens_forced, self.incomplete_filled, self.chord_index = snapshot
+        self.next_tokens_forced = collections.deque(next_tokens_forced)
+
     def validate_teacher_forced_sequence(self, seq) -> None:
         def _count_num_chord(seq):
             chord_counter = 0
@@ -154,9 +171,10 @@ class TeacherForceTask:
         num_bars = seq.count(TOKEN_OFFSET.BAR.value)
         num_chord = _count_num_chord(seq)
 
-        if len(self.chord_token) != 0:
+        num_remnant_chords = self.chord_length - self.chord_index
+        if num_remnant_chords != 0:
             raise Exception(
-                f"remnant chord length: {len(self.chord_token)} \n" "error in teacher forcing"
+                f"remnant chord length: {num_remnant_chords} \n" "error in teacher forcing"
             )
         elif num_bars != int(math.ceil(self.input_data.num_measures)):
             raise Exception(f"bar length: {num_bars} \n" "error in bar length")
@@ -169,13 +187,68 @@ class TeacherForceTask:
             logger.info(seq)
 
 
+@dataclass
+class BarSnapshot:
+    """
+    state of a sequence right after a sampled bar token, before it is fed
+    """
+    seq_len: int
+    num_steps: int
+    num_bars: int
+    num_fed: int
+    teacher: Tuple[List[int], bool, int]
+
+
+class SequenceState:
+    """
+    decoding state of a single sequence inside a (possibly batched) generation loop
+    """
+    def __init__(
+        self, seq: List[int], input_data: TransXlInputData, generator: Optional["torch.Generator"] = None
+    ):
+        self.seq = seq
+        self.input_data = input_data
+        # sampling generator of this sequence, the global one if None
+        self.generator = generator
+        # tokens allowed by the metadata, on top of the grammar, if None
+        self.meta_mask = None
+        self.teacher = TeacherForceTask(input_data)
+        self.logits = None
+        self.num_steps = 0
+        self.num_bars = seq.count(TOKEN_OFFSET.BAR.value)
+        self.sample_after_forward = False
+        self.failed = False
+        # tokens known to be fed next, before anything needs to be sampled
+        self.pending_inputs = collections.deque()
+        # tokens fed to the model so far, after the conditional prefix
+        self.num_fed = 0
+        # last good bar to roll back to on a failure
+        self.bar_snapshot: Optional[BarSnapshot] = None
+        self.num_rollbacks = 0
+
+    def append(self, token: int) -> None:
+        self.seq.append(token)
+        if token == TOKEN_OFFSET.BAR.value:
+            self.num_bars += 1
+
+
 class InferenceTask:
-    def __init__(self, device: torch.device):
+    def __init__(self, device: Optional["torch.device"]):
+        """
+        without a device, sequences are decoded on numpy arrays and torch is not imported (see OnnxDecoder)
+        """
         self.device = device
+        self.grammar = TokenGrammar(device)
+        if device is None:
+            self.sampler = NumpyTokenSampler(TOKEN_OFFSET.VOCAB_SIZE.value - 1)
+        else:
+            from commu.midi_generator.token_sampler import TokenSampler
+
+            self.sampler = TokenSampler(TOKEN_OFFSET.VOCAB_SIZE.value - 1, device)
 
     def __call__(
         self,
-        model: MemTransformerLM,
+        model: "MemTransformerLM",
         input_data: TransXlInputData,
         inference_cfg: yacs.config.CfgNode,
     ):
@@ -185,139 +258,411 @@ class InferenceTask:
 
     def init_seq_and_mems(
         self, encoded_meta: List[int], num_conditional_tokens: int
-    ) -> Tuple[List[int], torch.Tensor]:
+    ) -> Tuple[List[int], "DecodeMemory", "torch.Tensor"]:
+        init_seqs, init_mems, init_logits = self.init_seqs_and_mems([encoded_meta], num_conditional_tokens)
+        return init_seqs[0], init_mems, init_logits
 
+    def init_seqs_and_mems(
+        self, encoded_metas: List[List[int]], num_conditional_tokens: int
+    ) -> Tuple[List[List[int]], "DecodeMemory", "torch.Tensor"]:
+        """
+        run the conditional prefixes of a batch of sequences through the model at once
+        return the memory and the logits of the first token to sample, so that decoding starts with a sample
+        the last conditional token is left out of the memory on purpose, the model was only ever fed
+        from the token sampled after it
+        prefixes found in the prefix cache are not run again, decoding starts from a copy of their memory
+        """
         seq = [0]
-        ctx = np.array(seq + encoded_meta[: num_conditional_tokens - 1], dtype=np.int32)[
-            :, np.newaxis
+        prefixes = [
+            tuple(seq + encoded_meta[:num_conditional_tokens]) for encoded_meta in encoded_metas
         ]
-        context = torch.from_numpy(ctx).to(self.device).type(torch.long)
-        _, init_mems = self.model.forward_generate(context, mems=None)
-        init_seq = seq + encoded_meta[:num_conditional_tokens]
-        return init_seq, init_mems
-
-    def calc_logits_and_mems(
-        self, seq: List[int], mems: torch.Tensor
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
-        inp = np.array([seq[-1]], dtype=np.int32)[:, np.newaxis]
-        input_token = torch.from_numpy(inp).to(self.device).type(torch.long)
-        ret = self.model.forward_generate(input_token, mems)
-        all_logits, mems = ret
-        logits = all_logits[-1, 0][1:]
-        return logits, mems
-
-    def calc_probs(self, logits):
-        # Handle temp 0 (argmax) case
-        if self.input_data.temperature == 0:
-            probs = torch.zeros_like(logits)
-            probs[logits.argmax()] = 1.0
-        else:
-            # Apply temperature spec
-            logits /= self.input_data.temperature
-            # Compute softmax
-            probs = F.softmax(logits, dim=-1)
-
-        probs = F.pad(probs, [1, 0])
-        return probs
-
-    def apply_sampling(self, probs, wrong_tokens):
-        _, top_idx = torch.topk(probs, self.input_data.top_k)
-        mask = torch.zeros_like(probs)
-        mask[top_idx] = 1.0
-        if wrong_tokens:
-            for w in wrong_tokens:
-                mask[w] = 0.0
-        probs *= mask
-        probs /= torch.sum(probs)
-        return probs
-
-    def infer_token(self, probs):
-        token = torch.multinomial(probs, 1)
-        token = int(token.item())
-        return token
-
-    def generate_sequence(self, seq, mems):
-        logits = None
-        teacher = TeacherForceTask(self.input_data)
-        first_loop = True
-        for _ in range(self.inference_cfg.GENERATION.generation_length):
-            if seq[-1] == 1:
-                break
+        prefix_cache = get_prefix_cache(self.model, self.inference_cfg.GENERATION.prefix_cache_bytes)
+        prefix_entries = {}
+        if prefix_cache is not None:
+            for prefix in set(prefixes):
+                cached = prefix_cache.get(prefix)
+                if cached is not None:
+                    prefix_entries[prefix] = cached
+
+        missing = [prefix for prefix in dict.fromkeys(prefixes) if prefix not in prefix_entries]
+        if missing:
+            mems = self.model.init_decode_memory(len(missing))
+            logits, mems = self.calc_batch_logits_and_mems(list(zip(*missing)), mems)
+            mems.truncate(len(mems) - 1)
+            for batch_idx, prefix in enumerate(missing):
+                # logits[[batch_idx]] copies the row, instead of keeping a view of the whole batch
+                prefix_entries[prefix] = (mems.clone([batch_idx], capacity=len(mems)), logits[[batch_idx]][0])
+                if prefix_cache is not None:
+                    prefix_cache.put(prefix, prefix_entries[prefix])
+
+        memories = [prefix_entries[prefix][0] for prefix in prefixes]
+        init_mems = type(memories[0]).cat(memories)
+        # a copy, logits are modified in place while sampling
+        init_logits = self.sampler.stack([prefix_entries[prefix][1] for prefix in prefixes])
+        init_seqs = [seq + encoded_meta[:num_conditional_tokens] for encoded_meta in encoded_metas]
+        return init_seqs, init_mems, init_logits
+
+    def calc_batch_logits_and_mems(
+        self, tokens: List[List[int]], mems: "DecodeMemory"
+    ) -> Tuple["torch.Tensor", "DecodeMemory"]:
+        """
+        feed a segment of tokens (qlen x bsz) at once, only the logits after its last position are returned
+        """
+        all_logits, mems = self.model.forward_generate(self.sampler.tokens(tokens), mems)
+        return self.sampler.last_logits(all_logits), mems
 
-            if teacher.next_tokens_forced:
-                next_token = teacher.next_tokens_forced.pop(0)
-                seq.append(next_token)
-                logits, mems = self.calc_logits_and_mems(seq, mems)
-                continue
-
-            if teacher.no_sequence_appended:
-                assert logits is not None
-                teacher.no_sequence_appended = False
-            elif first_loop:
-                logits, _ = self.calc_logits_and_mems(seq, mems)
-                first_loop = False
-            else:
-                logits, mems = self.calc_logits_and_mems(seq, mems)
-
-            probs = self.calc_probs(logits)
-            probs = self.apply_sampling(probs, teacher.wrong_tokens)
-
-            # teacher forcing
-            # in case with incomplete measure, trigger a flag after second bar token
-            if not teacher.incomplete_filled:
-                teacher.incomplete_filled = True if seq.count(TOKEN_OFFSET.BAR.value) > 1 else False
-
-            # forcefully assign position 1/128 right after bar token
-            if teacher.check_first_position(seq):
-                teacher.teach_first_position()
-                continue
-
-            # in case there is one chord per bar
-            if teacher.check_one_chord_per_bar_case(seq):
-                teacher.teach_chord_token()
-                continue
-
-            # in case the chord changes within a bar
-            if teacher.check_mul_chord_per_bar_case(seq):
-                teacher.teach_chord_token()
-                continue
-
-            # teacher forcing followed by token inference so that we can check if the wrong token was generated
-            try:
-                token = self.infer_token(probs)
-            except RuntimeError as e:
-                logger.error(f"Sampling Error: {e}")
-                seq = None
-                break
+    def sequence_generator(self, number: int) -> Optional[Any]:
+        """
+        sampling generator of the `number`-th sequence of a generation, seeded with SAMPLING.seed + number
+        None when SAMPLING.seed is negative, sequences then share the global generator
+        """
+        seed = self.inference_cfg.SAMPLING.seed
+        if seed < 0:
+            return None
+        return self.sampler.generator(seed + number)
+
+    def init_state(self, seq: List[int], input_data: TransXlInputData, number: int) -> SequenceState:
+        state = SequenceState(seq, input_data, self.sequence_generator(number))
+        if input_data.meta_constraints:
+            state.meta_mask = self.grammar.meta_mask(
+                input_data.pitch_range,
+                input_data.min_velocity,
+                input_data.max_velocity,
+                self.inference_cfg.SAMPLING.pitch_margin,
+            )
+        return state
+
+    def sample_tokens(self, states: List[SequenceState]) -> List[int]:
+        """
+        sample the next token of several sequences at once from their logits, under the grammar
+        0 stands for a sequence with nothing left to sample
+        """
+        # logits do not include the padding token
+        logits = self.sampler.stack([state.logits for state in states])
+        allowed = self.grammar.allowed_tokens_batch([state.seq[-1] for state in states])
+        if any(state.meta_mask is not None for state in states):
+            meta_masks = [self.grammar.all_tokens if state.meta_mask is None else state.meta_mask for state in states]
+            allowed = allowed & self.sampler.stack(meta_masks)
+        allowed = allowed[:, 1:]
+        temperatures = [state.input_data.temperature for state in states]
+        top_ks = [state.input_data.top_k for state in states]
+        generators = [state.generator for state in states]
+        if any(generator is None for generator in generators):
+            generators = None
+        return self.sampler.sample(logits, allowed, temperatures, top_ks, generators)
+
+    def next_input_token(self, state: SequenceState) -> Optional[int]:
+        """
+        return the token to feed to the model next, or None once the sequence is finished
+        """
+        if (
+            state.failed
+            or state.seq[-1] == 1
+            or state.num_steps == self.inference_cfg.GENERATION.generation_length
+        ):
+            return None
+        state.num_steps += 1
+
+        if state.teacher.next_tokens_forced:
+            next_token = state.teacher.next_tokens_forced.popleft()
+            state.append(next_token)
+            state.sample_after_forward = False
+            return next_token
+
+        state.sample_after_forward = True
+        return state.seq[-1]
+
+    def next_input_tokens(self, state: SequenceState) -> List[int]:
+        """
+        the run of tokens to feed to the model before the next token needs to be sampled, empty once finished
+        forced tokens that do not depend on the logits (e.g. the position and chord right after a bar)
+        are taught upfront, so that the whole run goes through the model as one segment
+        """
+        tokens = []
+        while True:
+            token = self.next_input_token(state)
+            if token is None:
+                return tokens
+            tokens.append(token)
+            # a forced token is fed again before sampling, see next_input_token
+            if state.sample_after_forward and not self.teach_next_token(state):
+                return tokens
+
+    def teach_next_token(self, state: SequenceState) -> bool:
+        """
+        teacher forcing that does not depend on the logits, return whether a token was taught
+        """
+        seq, teacher = state.seq, state.teacher
+        # teacher forcing
+        # in case with incomplete measure, trigger a flag after second bar token
+        if not teacher.incomplete_filled:
+            teacher.incomplete_filled = state.num_bars > 1
+
+        # forcefully assign position 1/128 right after bar token
+        if teacher.check_first_position(seq):
+            teacher.teach_first_position()
+            return True
 
-            # generated token skipped necessary position
-            if teacher.check_chord_position_passed(token):
-                teacher.teach_chord_position()
-                continue
+        # in case there is one chord per bar
+        if teacher.check_one_chord_per_bar_case(seq):
+            teacher.teach_chord_token()
+            return True
 
-            # wrong chord token generated
-            if teacher.check_wrong_chord_token_generated(token):
-                teacher.teach_wrong_chord_token(token)
-                continue
+        # in case the chord changes within a bar
+        if teacher.check_mul_chord_per_bar_case(seq):
+            teacher.teach_chord_token()
+            return True
 
-            # eos generated but we got more chords to write
-            if teacher.check_wrong_eos_generated(token):
-                teacher.teach_remnant_chord()
-                continue
+        return False
 
-            # bar token generated but num measures exceed
-            if teacher.check_wrong_bar_token_generated(token):
-                teacher.teach_eos()
-                continue
+    def sample_next_token(self, state: SequenceState) -> None:
+        self.sample_next_tokens([state])
 
-            seq.append(token)
+    def sample_next_tokens(self, states: List[SequenceState]) -> None:
+        """
+        next token of each sequence after a forward pass, sampled in one batch unless teacher forced
+        """
+        states = [state for state in states if not self.teach_next_token(state)]
+        if not states:
+            return
+        for state, token in zip(states, self.sample_tokens(states)):
+            self.accept_sampled_token(state, token)
+
+    def accept_sampled_token(self, state: SequenceState, token: int) -> None:
+        teacher = state.teacher
+        # teacher forcing followed by token inference so that we can check if the wrong token was generated
+        if token == 0:
+            logger.error("Sampling Error: no token can be sampled")
+            state.failed = True
+            return
+
+        # generated token skipped necessary position
+        if teacher.check_chord_position_passed(token):
+            teacher.teach_chord_position()
+            return
+
+        # eos generated but we got more chords to write
+        if teacher.check_wrong_eos_generated(token):
+            teacher.teach_remnant_chord()
+            return
+
+        # bar token generated but num measures exceed
+        if teacher.check_wrong_bar_token_generated(token):
+            teacher.teach_eos()
+            return
+
+        state.append(token)
+        # structural failure, no need to decode the rest of the sequence
+        if teacher.check_too_many_bars(state.num_bars):
+            logger.error(f"bar length exceeded: {state.num_bars}")
+            state.failed = True
+
+    def snapshot_bar(self, state: SequenceState) -> None:
+        """
+        keep the state of a sequence that just sampled a new bar, it must have no pending inputs
+        """
+        if state.failed or state.seq[-1] != TOKEN_OFFSET.BAR.value:
+            return
+        if state.bar_snapshot is not None and state.bar_snapshot.seq_len == len(state.seq):
+            return
+        state.bar_snapshot = BarSnapshot(
+            seq_len=len(state.seq),
+            num_steps=state.num_steps,
+            num_bars=state.num_bars,
+            num_fed=state.num_fed,
+            teacher=state.teacher.snapshot(),
+        )
 
+    def roll_back(self, state: SequenceState) -> Optional[int]:
+        """
+        bring a failed sequence back to its last bar snapshot, so that the bar is sampled again
+        return the number of positions to forget from the end of its memory, None if it cannot be rolled back
+        """
+        snapshot = state.bar_snapshot
+        if snapshot is None or state.num_rollbacks >= self.inference_cfg.GENERATION.max_rollbacks:
+            return None
+        # the positions of the bar must all still be in the memory window
+        if len(state.seq) > self.model.mem_len:
+            return None
+        state.num_rollbacks += 1
+        num_dropped = state.num_fed - snapshot.num_fed
+        del state.seq[snapshot.seq_len:]
+        state.num_steps = snapshot.num_steps
+        state.num_bars = snapshot.num_bars
+        state.num_fed = snapshot.num_fed
+        state.teacher.restore(snapshot.teacher)
+        state.failed = False
+        logger.info(f"Rolled back to bar {state.num_bars} ({state.num_rollbacks} rollbacks)")
+        return num_dropped
+
+    def num_committed(self, state: SequenceState, finished: bool) -> int:
+        """
+        length of the part of the sequence that no rollback can take back anymore
+        """
+        if finished or self.inference_cfg.GENERATION.max_rollbacks == 0:
+            return len(state.seq)
+        if state.bar_snapshot is None:
+            return 0
+        return state.bar_snapshot.seq_len
+
+    def finish_sequence(self, state: SequenceState) -> Optional[List[int]]:
+        if state.failed:
+            return None
         try:
-            teacher.validate_teacher_forced_sequence(seq)
+            state.teacher.validate_teacher_forced_sequence(state.seq)
         except Exception as error_message:
             logger.error(error_message)
-            seq = None
-        return seq
+            return None
+        if not self.validate_generated_sequence(state.seq):
+            logger.error("Empty sequence generated")
+            return None
+        return state.seq
+
+    def generate_sequence(self, seq, mems, logits):
+        return self.generate_sequences([seq], mems, logits, [self.input_data])[0]
+
+    def generate_sequences(
+        self,
+        seqs: List[List[int]],
+        mems: "DecodeMemory",
+        logits: "torch.Tensor",
+        input_data: List[TransXlInputData],
+        groups: Optional[List[int]] = None,
+        num_required: Optional[List[int]] = None,
+        numbers: Optional[List[int]] = None,
+        progress: bool = False,
+    ) -> List[Optional[List[int]]]:
+        """
+        advance a batch of sequences together, one forward pass per step
+        mems and logits are those returned by init_seqs_and_mems, the first token is sampled from the logits
+        every sequence keeps its own teacher forcing state and finish condition,
+        finished sequences are dropped from the batch (and from mems) as they go
+        with `groups`, sequences are candidates for group `groups[i]`: once `num_required[g]`
+        of them are finished and valid, the remaining candidates of group g are retired too
+        `numbers` number the sequences for their sampling generators (see sequence_generator)
+        `progress` shows a progress bar of the forward passes
+        """
+        if numbers is None:
+            numbers = list(range(len(seqs)))
+        states = [self.init_state(seq, data, number) for seq, data, number in zip(seqs, input_data, numbers)]
+        results = [None] * len(states)
+        steps = self.decode_steps(states, mems, logits, results, groups, num_required)
+        for _ in tqdm(steps, desc="Decoding", unit="step", disable=not progress):
+            pass
+        return results
+
+    def decode_steps(
+        self,
+        states: List[SequenceState],
+        mems: "DecodeMemory",
+        logits: "torch.Tensor",
+        results: List[Optional[List[int]]],
+        groups: Optional[List[int]] = None,
+        num_required: Optional[List[int]] = None,
+    ) -> Iterator[None]:
+        """
+        the generation loop of generate_sequences, yielding after every forward pass
+        finished sequences are written to `results` as they finish
+        runs of known tokens are fed as one segment, as long as the run of every sequence in the batch lasts
+        a failed sequence is rolled back to its last bar and decodes it again (see roll_back): alone, it goes on
+        from its truncated memory, within a batch, it joins the batch again with it (see DecodeMemory.cat)
+        exported decode steps have no padding mask, with them a failed sequence is only rolled back when it is
+        alone, within a batch it fails as before and execute_batch starts a new candidate
+        """
+        if groups is None:
+            groups, num_required = list(range(len(states))), [1] * len(states)
+        num_valid = [0] * len(num_required)
+        active = list(range(len(states)))
+        ragged = self.model.ragged_batches
+        sampled = []
+        for state, state_logits in zip(states, logits):
+            # the step on the last conditional token, its logits come with the prefix
+            if self.next_input_token(state) is not None:
+                state.logits = state_logits
+                sampled.append(state)
+        self.sample_next_tokens(sampled)
+        while active:
+            keep, rolled_back = [], []
+            for batch_idx, state_idx in enumerate(active):
+                state, group = states[state_idx], groups[state_idx]
+                if num_valid[group] >= num_required[group]:
+                    continue
+                if not state.pending_inputs:
+                    self.snapshot_bar(state)
+                    state.pending_inputs.extend(self.next_input_tokens(state))
+                if state.pending_inputs:
+                    keep.append(batch_idx)
+                    continue
+                results[state_idx] = self.finish_sequence(state)
+                if results[state_idx] is not None:
+                    num_valid[group] += 1
+                    continue
+                if len(active) > 1 and not ragged:
+                    continue
+                num_dropped = self.roll_back(state)
+                if num_dropped is None:
+                    continue
+                state.pending_inputs.extend(self.next_input_tokens(state))
+                if len(active) == 1:
+                    mems.truncate(len(mems) - num_dropped)
+                    keep.append(batch_idx)
+                else:
+                    memory = mems.clone([batch_idx])
+                    memory.truncate(len(memory) - num_dropped)
+                    rolled_back.append((state_idx, memory))
+            if len(keep) != len(active):
+                active = [active[batch_idx] for batch_idx in keep]
+                if active:
+                    mems.select_batch(keep)
+            if rolled_back:
+                # rolled back sequences go on in the batch, right-aligned with their shorter memory
+                memories = [memory for _, memory in rolled_back]
+                mems = type(mems).cat([mems] + memories if active else memories)
+                active += [state_idx for state_idx, _ in rolled_back]
+            if not active:
+                break
+
+            segment_len = min(len(states[state_idx].pending_inputs) for state_idx in active)
+            tokens = [
+                [states[state_idx].pending_inputs.popleft() for state_idx in active]
+                for _ in range(segment_len)
+            ]
+            logits, mems = self.calc_batch_logits_and_mems(tokens, mems)
+
+            sampled = []
+            for batch_idx, state_idx in enumerate(active):
+                state = states[state_idx]
+                state.num_fed += segment_len
+                state.logits = logits[batch_idx]
+                if state.sample_after_forward and not state.pending_inputs:
+                    sampled.append(state)
+            self.sample_next_tokens(sampled)
+            yield
+
+    def stream_tokens(self, encoded_meta: List[int]) -> Iterator[int]:
+        """
+        generate a single sequence, yielding the generated tokens as soon as no rollback can take them back,
+        i.e. bar by bar, or as soon as they are appended when rollbacks are disabled
+        the consumer may stop early by closing the generator, e.g. to cancel a generation
+        raises GenerationFailedError at the end if the finished sequence is not valid
+        """
+        with self.sampler.no_grad():
+            init_seqs, mems, logits = self.init_seqs_and_mems([encoded_meta], len(encoded_meta))
+        state = self.init_state(init_seqs[0], self.input_data, 0)
+        results = [None]
+        steps = self.decode_steps([state], mems, logits, results)
+        num_yielded = len(state.seq)
+        finished = False
+        while not finished:
+            # grad mode is thread local, so it must not stay disabled while the consumer runs
+            with self.sampler.no_grad():
+                finished = next(steps, StopIteration) is StopIteration
+            num_committed = self.num_committed(state, finished)
+            if num_committed > num_yielded:
+                yield from state.seq[num_yielded:num_committed]
+                num_yielded = num_committed
+        if results[0] is None:
+            raise GenerationFailedError("streamed sequence is not valid")
 
     def validate_generated_sequence(self, seq: List[int]) -> bool:
         num_note = 0
@@ -335,20 +680,85 @@ class InferenceTask:
                     num_note += 1
         return num_note > 0
 
+    def sample_cache(self) -> Optional[SampleCache]:
+        """
+        the sample cache, only used with a fixed seed: the sequences of a meta then only depend on its sample_key
+        """
+        if self.inference_cfg.SAMPLING.seed < 0:
+            return None
+        generation_cfg = self.inference_cfg.GENERATION
+        return get_sample_cache(generation_cfg.sample_cache_path, generation_cfg.sample_cache_bytes)
+
+    def sample_key(self, input_data: TransXlInputData, num_candidates: int) -> str:
+        return sample_key(input_data, self.inference_cfg, num_candidates, model_fingerprint(self.model))
+
     def execute(self, encoded_meta) -> List[List[int]]:
-        num_conditional_tokens = len(encoded_meta)
-        idx = 0
-        sequences = []
-        while idx != self.input_data.num_generate:
-            with torch.no_grad():
-                logger.info("Generating the idx: " + str(idx + 1))
-                seq, mems = self.init_seq_and_mems(encoded_meta, num_conditional_tokens)
-                seq = self.generate_sequence(seq, mems)
-                if seq is None:
-                    continue
-                if not self.validate_generated_sequence(seq):
-                    logger.error("Empty sequence generated")
-                    continue
-            sequences.append(seq)
-            idx += 1
+        return self.execute_batch([encoded_meta], [self.input_data])[0]
+
+    def execute_batch(
+        self,
+        encoded_metas: List[List[int]],
+        input_data: List[TransXlInputData],
+        num_candidates: Optional[int] = None,
+        progress: bool = False,
+    ) -> List[List[List[int]]]:
+        """
+        generate `num_generate` sequences for each of several encoded metas (e.g. one per track role)
+        at least `num_candidates` candidates per meta are decoded together, in a single batch:
+        the first valid ones are kept and the rest is retired, failed metas are retried in the next batch
+        the candidates of each meta are numbered on their own (see sequence_generator), so that with a fixed
+        seed the sequences of a meta do not depend on the other metas, and are replayed from the sample cache
+        """
+        if num_candidates is None:
+            num_candidates = self.inference_cfg.GENERATION.num_candidates
+        num_conditional_tokens = len(encoded_metas[0])
+        assert all(len(encoded_meta) == num_conditional_tokens for encoded_meta in encoded_metas)
+        sequences = [[] for _ in encoded_metas]
+        sample_cache = self.sample_cache()
+        if sample_cache is not None:
+            keys = [self.sample_key(data, num_candidates) for data in input_data]
+            for idx, key in enumerate(keys):
+                cached = sample_cache.get(key) or []
+                # a short entry is generated again from the first candidate rather than topped up:
+                # new candidates would be numbered from 0 and replay the cached sequences
+                if len(cached) >= input_data[idx].num_generate:
+                    sequences[idx] = cached[:input_data[idx].num_generate]
+            generated = [idx for idx, seqs in enumerate(sequences) if not seqs]
+        num_decoded = [0] * len(encoded_metas)
+        while True:
+            missing = [data.num_generate - len(seqs) for data, seqs in zip(input_data, sequences)]
+            pending = [idx for idx, num_missing in enumerate(missing) if num_missing > 0]
+            if not pending:
+                break
+            with self.sampler.no_grad():
+                logger.info(f"Generating sequences for {len(pending)} metas")
+                init_seqs, mems, logits = self.init_seqs_and_mems(
+                    [encoded_metas[idx] for idx in pending], num_conditional_tokens
+                )
+                # the prefix is computed once per meta, then copied for each of its candidates
+                positions = [
+                    pos for pos, idx in enumerate(pending) for _ in range(max(num_candidates, missing[idx]))
+                ]
+                mems.select_batch(positions)
+                candidates = [pending[pos] for pos in positions]
+                numbers = []
+                for idx in candidates:
+                    numbers.append(num_decoded[idx])
+                    num_decoded[idx] += 1
+                seqs = self.generate_sequences(
+                    [list(init_seqs[pos]) for pos in positions],
+                    mems,
+                    logits[positions],
+                    [input_data[idx] for idx in candidates],
+                    groups=candidates,
+                    num_required=missing,
+                    numbers=numbers,
+                    progress=progress,
+                )
+            for idx, seq in zip(candidates, seqs):
+                if seq is not None and len(sequences[idx]) < input_data[idx].num_generate:
+                    sequences[idx].append(seq)
+        if sample_cache is not None:
+            for idx in generated:
+                sample_cache.put(keys[idx], sequences[idx])
         return sequences
@@ -1,13 +1,20 @@
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Union
 
 import torch
+import torch.nn as nn
 import yacs.config
 
 from commu.midi_generator.container import ModelArguments
 from commu.model.config_helper import get_default_cfg_inference, get_default_cfg_training
 from commu.model.dataset import BaseVocab
-from commu.model.model import MemTransformerLM
+from commu.model.decode_step import ScriptedDecoder, load_decode_step
+from commu.model.flat_checkpoint import check_state_dict, is_flat_checkpoint, read_flat_state_dict
+from commu.model.model import LayerNorm, MemTransformerLM, PositionalEmbedding
+from commu.model.onnx_decoder import OnnxDecoder, load_onnx_decode_step
+from commu.midi_generator.model_registry import MODEL_REGISTRY
+
+REDUCED_PRECISIONS = {"bf16": torch.bfloat16, "fp16": torch.float16}
 
 
 class ModelInitializeTask:
@@ -43,15 +50,65 @@ class ModelInitializeTask:
     def initialize_model(self, training_cfg, model_fp):
         perform_vocab = BaseVocab()
         model = MemTransformerLM(training_cfg, perform_vocab)
-        checkpoint = torch.load(model_fp, map_location=torch.device("cuda" if torch.cuda.is_available() else "cpu"))
-        model.load_state_dict(checkpoint["model"], strict=False)
+        if is_flat_checkpoint(model_fp):
+            # parameters become views of the mapped file instead of copies (see commu.model.flat_checkpoint)
+            model.load_state_dict(read_flat_state_dict(model_fp), assign=True)
+            model.tie_weights()
+        else:
+            checkpoint = torch.load(model_fp, map_location=torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+            model.load_state_dict(check_state_dict(model, checkpoint["model"]))
         model = model.to(self.device)
         model.eval()
         model.reset_length(1, self.inference_cfg.MODEL.memory_length)
+        if self.model_args.precision == "int8":
+            model = self.quantize_model(model)
+        elif self.model_args.precision in REDUCED_PRECISIONS:
+            model = self.cast_model(model, REDUCED_PRECISIONS[self.model_args.precision])
         return model
 
-    def execute(self):
+    def quantize_model(self, model: MemTransformerLM) -> MemTransformerLM:
+        """
+        int8 dynamic quantization of the linear layers of the decoder (qkv_net, o_net, r_net, PositionwiseFF)
+        the output layer is left in fp32 since its weight is tied to the embedding
+        """
+        if self.device.type != "cpu":
+            raise ValueError("int8 dynamic quantization is only supported on CPU")
+        model.layers = torch.quantization.quantize_dynamic(model.layers, {nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def cast_model(self, model: MemTransformerLM, dtype: torch.dtype) -> MemTransformerLM:
+        """
+        weights, and therefore the decode memory, in dtype
+        layer norms and the sinusoids of the position embedding keep fp32 parameters and are computed in fp32,
+        as are the attention softmax and the logits once sampled
+        """
+        model = model.to(dtype)
+        for module in model.modules():
+            if isinstance(module, (LayerNorm, PositionalEmbedding)):
+                module.float()
+        return model
+
+    def registry_key(self) -> Tuple[str, str, str]:
+        if self.model_args.onnx_decode_step:
+            return str(Path(self.model_args.onnx_decode_step).resolve()), str(self.device), "onnx_decode_step"
+        if self.model_args.decode_step:
+            return str(Path(self.model_args.decode_step).resolve()), str(self.device), "decode_step"
+        model_fp, _ = self.load_checkpoint_fp()
+        return str(model_fp.resolve()), str(self.device), self.model_args.precision
+
+    def load(self) -> Tuple[Union[MemTransformerLM, ScriptedDecoder, OnnxDecoder], yacs.config.CfgNode]:
+        if self.model_args.onnx_decode_step:
+            if self.device.type != "cpu":
+                raise ValueError("the onnxruntime backend is only supported on CPU")
+            return load_onnx_decode_step(self.model_args.onnx_decode_step), self.inference_cfg
+        if self.model_args.decode_step:
+            # the precision and the memory length were fixed at export time
+            return load_decode_step(self.model_args.decode_step, self.device), self.inference_cfg
         model_fp, training_cfg_fp = self.load_checkpoint_fp()
         training_cfg = self.initialize_training_cfg()
         model = self.initialize_model(training_cfg, model_fp)
-        return model
\ No newline at end of file
+        return model, self.inference_cfg
+
+    def execute(self):
+        model, self.inference_cfg = MODEL_REGISTRY.get_or_load(self.registry_key(), self.load)
+        return model
@@ -0,0 +1,29 @@
+import threading
+from typing import Callable, Dict, Hashable, Tuple
+
+import yacs.config
+
+from commu.logger import logger
+from commu.model.model import MemTransformerLM
+
+RegistryEntry = Tuple[MemTransformerLM, yacs.config.CfgNode]
+
+
+class ModelRegistry:
+    """
+    process-wide store of initialized models
+    each checkpoint is loaded once and the warm model is shared by every pipeline
+    """
+    def __init__(self):
+        self._entries: Dict[Hashable, RegistryEntry] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], RegistryEntry]) -> RegistryEntry:
+        with self._lock:
+            if key not in self._entries:
+                logger.info(f"Loading model into registry: {key}")
+                self._entries[key] = loader()
+            return self._entries[key]
+
+
+MODEL_REGISTRY = ModelRegistry()  # singleton
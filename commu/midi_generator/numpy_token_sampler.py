@@ -0,0 +1,74 @@
+import contextlib
+from typing import List, Optional
+
+import numpy as np
+
+
+class NumpyTokenSampler:
+    def __init__(self, vocab_size: int):
+        """
+        TokenSampler on numpy arrays, for decoders running without torch (see OnnxDecoder)
+        a generator seeded with the same seed draws the same uniform numbers as a torch generator on CPU,
+        so that the sequences of a seed do not depend on the library they are sampled with
+        """
+        self.ranks = np.arange(vocab_size)
+
+    def tokens(self, tokens: List[List[int]]) -> np.ndarray:
+        return np.array(tokens, dtype=np.int64)
+
+    def last_logits(self, logits: np.ndarray) -> np.ndarray:
+        """
+        fp32 logits after the last position of a segment [qlen x bsz x n_token], without the padding token
+        """
+        return logits[-1, :, 1:].astype(np.float32, copy=False)
+
+    def stack(self, rows: List[np.ndarray]) -> np.ndarray:
+        return np.stack(rows)
+
+    def generator(self, seed: int) -> np.random.RandomState:
+        # the same Mersenne Twister, seeded the same way, as torch.Generator.manual_seed
+        return np.random.RandomState(seed)
+
+    def no_grad(self):
+        return contextlib.nullcontext()
+
+    def uniforms(self, bsz: int, generators: Optional[List[np.random.RandomState]]) -> np.ndarray:
+        if generators is None:
+            return np.random.random_sample(bsz).astype(np.float32)
+        # torch.rand keeps the low 24 bits of a 32-bit draw
+        draws = np.array([generator.randint(0, 2 ** 32, dtype=np.uint32) for generator in generators])
+        return (draws & (2 ** 24 - 1)).astype(np.float32) * np.float32(2 ** -24)
+
+    def sample(
+        self,
+        logits: np.ndarray,
+        allowed: np.ndarray,
+        temperatures: List[float],
+        top_ks: List[int],
+        generators: Optional[List[np.random.RandomState]] = None,
+    ) -> List[int]:
+        """
+        same as TokenSampler.sample
+        """
+        bsz = logits.shape[0]
+        max_k = min(max(top_ks), logits.shape[1])
+        masked = np.where(allowed, logits, np.float32(-np.inf))
+        indices = np.argsort(-masked, axis=-1, kind="stable")[:, :max_k]
+        values = np.take_along_axis(masked, indices, axis=-1)
+        if min(top_ks) < max_k:
+            values[self.ranks[:max_k] >= np.array(top_ks)[:, None]] = -np.inf
+        scales = [temperature if temperature > 0 else 1.0 for temperature in temperatures]
+        values /= np.array(scales, dtype=values.dtype)[:, None]
+
+        # rows with nothing allowed are all nan
+        with np.errstate(invalid="ignore"):
+            exps = np.exp(values - values.max(axis=-1, keepdims=True))
+            cdf = np.cumsum(exps / exps.sum(axis=-1, keepdims=True), axis=-1)
+        targets = self.uniforms(bsz, generators) * cdf[:, -1]
+        # the first rank whose cumulated probability exceeds the target, ranks of probability 0 are never picked
+        choices = np.minimum((cdf <= targets[:, None]).sum(axis=-1), max_k - 1)
+        if 0 in temperatures:
+            choices[[temperature == 0 for temperature in temperatures]] = 0
+        # 0 when nothing is allowed, or when the logits are not finite
+        tokens = (np.take_along_axis(indices, choices[:, None], axis=-1)[:, 0] + 1) * (cdf[:, -1] > 0)
+        return tokens.tolist()
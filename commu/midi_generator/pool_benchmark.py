@@ -0,0 +1,120 @@
+import argparse
+import time
+from dataclasses import dataclass
+from typing import List
+
+import yacs.config
+
+from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+from commu.midi_generator.generation_pool import GenerationJob, GenerationPool
+from commu.midi_generator.info_preprocessor import PreprocessTask
+from commu.model.model import MemTransformerLM
+
+
+@dataclass
+class ScalingReport:
+    num_workers: int
+    num_threads: int
+    sequences_per_sec: float
+
+
+def benchmark_jobs(num_jobs: int) -> List[GenerationJob]:
+    preprocess_task = PreprocessTask()
+    encoded_meta = preprocess_task.excecute({
+        "track_role": "main_melody",
+        "bpm": 120,
+        "audio_key": "aminor",
+        "time_signature": "4/4",
+        "num_measures": 8,
+        "genre": "newage",
+        "rhythm": "standard",
+        "chord_progression": "-".join(chord for chord in ["Am", "C", "G", "D"] * 2 for _ in range(8)),
+        "pitch_range": "mid",
+        "inst": "acoustic_piano",
+        "min_velocity": 60,
+        "max_velocity": 80,
+        "top_k": 32,
+        "temperature": 0.95,
+        "output_dir": "out",
+        "num_generate": 1,
+    })
+    return [([encoded_meta], [preprocess_task.input_data], 1)] * num_jobs
+
+
+def benchmark_pool(
+        model: MemTransformerLM,
+        inference_cfg: yacs.config.CfgNode,
+        num_workers: int,
+        num_threads: int,
+        num_jobs: int,
+) -> ScalingReport:
+    """
+    throughput of a generation pool on `num_jobs` jobs of a single sequence, as make_midis submits the track roles
+    the seed is fixed so that every job decodes the same sequence, workers are warmed up before timing
+    """
+    jobs = benchmark_jobs(num_jobs)
+    pool = GenerationPool(model, inference_cfg, num_workers, num_threads)
+    try:
+        pool.map(jobs[:num_workers])
+        start = time.perf_counter()
+        pool.map(jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+    return ScalingReport(
+        num_workers=num_workers,
+        num_threads=pool.num_threads,
+        sequences_per_sec=num_jobs / elapsed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--num_workers",
+        dest="num_workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument(
+        "--threads_per_worker",
+        dest="threads_per_worker",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--num_jobs",
+        dest="num_jobs",
+        type=int,
+        default=128)
+    parser.add_argument(
+        "--generation_length",
+        dest="generation_length",
+        type=int,
+        default=512)
+    args = parser.parse_args()
+
+    pipeline = MidiGenerationPipeline({"checkpoint_dir": args.checkpoint_dir})
+    model = pipeline.model_initialize_task.execute()
+    inference_cfg = pipeline.model_initialize_task.inference_cfg.clone()
+    inference_cfg.defrost()
+    inference_cfg.SAMPLING.seed = 0
+    inference_cfg.GENERATION.generation_length = args.generation_length
+    inference_cfg.GENERATION.sample_cache_path = ""
+    inference_cfg.freeze()
+
+    reports = [
+        benchmark_pool(model, inference_cfg, num_workers, args.threads_per_worker, args.num_jobs)
+        for num_workers in args.num_workers
+    ]
+    reference = reports[0]
+    for report in reports:
+        speedup = report.sequences_per_sec / reference.sequences_per_sec
+        efficiency = speedup * reference.num_workers / report.num_workers
+        print(
+            f"{report.num_workers:>3} workers x {report.num_threads} threads: "
+            f"{report.sequences_per_sec:8.2f} sequences/s ({speedup:.2f}x, {efficiency:.0%} of linear)")
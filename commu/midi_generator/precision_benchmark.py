@@ -0,0 +1,89 @@
+import argparse
+import time
+from dataclasses import dataclass
+
+import torch
+
+from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+from commu.model.model import MemTransformerLM
+from commu.preprocessor.encoder import TOKEN_OFFSET
+
+
+@dataclass
+class PrecisionReport:
+    precision: str
+    bytes_per_sequence: int
+    tokens_per_sec: float
+
+
+def benchmark_precision(
+        model: MemTransformerLM,
+        precision: str,
+        batch_size: int,
+        context_len: int,
+        num_steps: int,
+) -> PrecisionReport:
+    """
+    decode memory allocated per concurrent sequence, and decoding throughput of `batch_size` sequences
+    one token at a time on top of a `context_len` tokens context
+    """
+    device = next(model.parameters()).device
+    torch.manual_seed(0)
+    context = torch.randint(1, TOKEN_OFFSET.VOCAB_SIZE.value, (context_len, batch_size), device=device)
+    tokens = torch.randint(1, TOKEN_OFFSET.VOCAB_SIZE.value, (num_steps, 1, batch_size), device=device)
+    with torch.no_grad():
+        mems = model.init_decode_memory(batch_size)
+        _, mems = model.forward_generate(context, mems)
+        start = time.perf_counter()
+        for step in range(num_steps):
+            _, mems = model.forward_generate(tokens[step], mems)
+        elapsed = time.perf_counter() - start
+    return PrecisionReport(
+        precision=precision,
+        bytes_per_sequence=mems.nbytes // batch_size,
+        tokens_per_sec=num_steps * batch_size / elapsed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--precisions",
+        dest="precisions",
+        type=str,
+        nargs="+",
+        default=["fp32", "bf16", "fp16"])
+    parser.add_argument(
+        "--batch_size",
+        dest="batch_size",
+        type=int,
+        default=8)
+    parser.add_argument(
+        "--context_len",
+        dest="context_len",
+        type=int,
+        default=1024)
+    parser.add_argument(
+        "--num_steps",
+        dest="num_steps",
+        type=int,
+        default=64)
+    args = parser.parse_args()
+
+    reports = []
+    for precision in args.precisions:
+        pipeline = MidiGenerationPipeline({"checkpoint_dir": args.checkpoint_dir, "precision": precision})
+        model = pipeline.model_initialize_task.execute()
+        reports.append(
+            benchmark_precision(model, precision, args.batch_size, args.context_len, args.num_steps))
+    reference = reports[0]
+    for report in reports:
+        print(
+            f"{report.precision:>5}: {report.bytes_per_sequence / 1024 ** 2:8.1f} MiB/sequence "
+            f"({report.bytes_per_sequence / reference.bytes_per_sequence:.2f}x), "
+            f"{report.tokens_per_sec:8.1f} tokens/s ({report.tokens_per_sec / reference.tokens_per_sec:.2f}x)")
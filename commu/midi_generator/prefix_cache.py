@@ -0,0 +1,81 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from commu.logger import logger
+
+# decode memory after a conditional prefix, and the logits of the token following it,
+# a DecodeMemory and a tensor, or a NumpyDecodeMemory and an array for OnnxDecoder
+PrefixEntry = Tuple[Any, Any]
+
+
+def entry_nbytes(entry: PrefixEntry) -> int:
+    memory, logits = entry
+    return memory.nbytes + logits.nbytes
+
+
+class PrefixCache:
+    """
+    LRU cache of the decode memory and next-token logits right after a conditional prefix,
+    keyed by the prefix tokens
+    entries are compact copies, evicted least recently used first once `max_bytes` is exceeded
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, PrefixEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[PrefixEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: PrefixEntry) -> None:
+        """
+        the entry is stored as is: it should be a compact copy that nobody decodes from in place
+        """
+        nbytes = entry_nbytes(entry)
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            if key in self._entries:
+                self.num_bytes -= entry_nbytes(self._entries.pop(key))
+            self._entries[key] = entry
+            self.num_bytes += nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= entry_nbytes(evicted)
+                logger.info("Evicted a prefix from the prefix cache")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+
+_PREFIX_CACHES: "weakref.WeakKeyDictionary[Any, PrefixCache]" = weakref.WeakKeyDictionary()
+_PREFIX_CACHES_LOCK = threading.Lock()
+
+
+def get_prefix_cache(model: Any, max_bytes: int) -> Optional[PrefixCache]:
+    """
+    process-wide prefix cache of a model, None when disabled (max_bytes=0)
+    """
+    if max_bytes <= 0:
+        return None
+    with _PREFIX_CACHES_LOCK:
+        if model not in _PREFIX_CACHES:
+            _PREFIX_CACHES[model] = PrefixCache(max_bytes)
+        return _PREFIX_CACHES[model]
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import yacs.config
+
+from commu.logger import logger
+from commu.midi_generator.container import TransXlInputData
+from commu.model.onnx_decoder import OnnxDecoder
+
+if TYPE_CHECKING:
+    from commu.model.model import MemTransformerLM
+
+# bumped whenever the generation code changes the sequences generated for the same key
+SAMPLE_CACHE_VERSION = 1
+
+
+class SampleCache:
+    """
+    on-disk cache of generated sequences in a SQLite database, keyed by sample_key
+    entries are evicted least recently used first once their total size exceeds `max_bytes`
+    the database can be shared by several processes, each opening its own connection
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS samples "
+            "(key TEXT PRIMARY KEY, sequences BLOB NOT NULL, num_bytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS samples_last_used ON samples (last_used)")
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    @property
+    def num_bytes(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(num_bytes), 0) FROM samples").fetchone()[0]
+
+    def get(self, key: str) -> Optional[List[List[int]]]:
+        with self._lock:
+            row = self._connection.execute("SELECT sequences FROM samples WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE samples SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, sequences: List[List[int]]) -> None:
+        blob = json.dumps(sequences, separators=(",", ":")).encode("utf-8")
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)", (key, blob, len(blob), time.time())
+                )
+                num_bytes = connection.execute("SELECT SUM(num_bytes) FROM samples").fetchone()[0]
+                while num_bytes > self.max_bytes:
+                    evicted_key, evicted_bytes = connection.execute(
+                        "SELECT key, num_bytes FROM samples ORDER BY last_used LIMIT 1"
+                    ).fetchone()
+                    connection.execute("DELETE FROM samples WHERE key = ?", (evicted_key,))
+                    num_bytes -= evicted_bytes
+                    logger.info("Evicted a sample from the sample cache")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM samples")
+
+
+def _feed(digest: "hashlib._Hash", value: Any) -> None:
+    # only fed the state of torch models, an OnnxDecoder is hashed from its file
+    import torch
+
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            value = value.dequantize()
+        value = value.detach().cpu().contiguous()
+        digest.update(f"{value.dtype}{tuple(value.shape)}".encode("utf-8"))
+        digest.update(value.view(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _feed(digest, item)
+    else:
+        digest.update(repr(value).encode("utf-8"))
+
+
+_FINGERPRINTS: "weakref.WeakKeyDictionary[Any, str]" = weakref.WeakKeyDictionary()
+_FINGERPRINTS_LOCK = threading.Lock()
+
+
+def model_fingerprint(model: "MemTransformerLM") -> str:
+    """
+    hash of the weights a model decodes with, computed once per model
+    quantized and reduced precision copies of a checkpoint get their own fingerprint
+    """
+    with _FINGERPRINTS_LOCK:
+        if model not in _FINGERPRINTS:
+            digest = hashlib.sha256()
+            if isinstance(model, OnnxDecoder):
+                digest.update(Path(model.path).read_bytes())
+            else:
+                # a ScriptedDecoder holds its weights in its scripted step
+                module = getattr(model, "step", model)
+                for name, value in module.state_dict().items():
+                    digest.update(name.encode("utf-8"))
+                    _feed(digest, value)
+            _FINGERPRINTS[model] = digest.hexdigest()
+        return _FINGERPRINTS[model]
+
+
+def sample_key(
+    input_data: TransXlInputData,
+    inference_cfg: yacs.config.CfgNode,
+    num_candidates: int,
+    fingerprint: str,
+) -> str:
+    """
+    hash of everything the sequences generated for a meta depend on with a fixed seed: the input data
+    but its output directory, the sampling seed, the generation settings and the model
+    """
+    content = {
+        "version": SAMPLE_CACHE_VERSION,
+        "input_data": json.loads(input_data.json(exclude={"output_dir"})),
+        "seed": inference_cfg.SAMPLING.seed,
+        "pitch_margin": inference_cfg.SAMPLING.pitch_margin,
+        "generation_length": inference_cfg.GENERATION.generation_length,
+        "max_rollbacks": inference_cfg.GENERATION.max_rollbacks,
+        "num_candidates": num_candidates,
+        "model": fingerprint,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+_SAMPLE_CACHES: Dict[Tuple[int, str], SampleCache] = {}
+_SAMPLE_CACHES_LOCK = threading.Lock()
+
+
+def get_sample_cache(path: str, max_bytes: int) -> Optional[SampleCache]:
+    """
+    process-wide sample cache stored at `path`, None when disabled (empty path or max_bytes=0)
+    connections are not carried over a fork, a forked process opens its own
+    """
+    if not path or max_bytes <= 0:
+        return None
+    key = (os.getpid(), str(Path(path).resolve()))
+    with _SAMPLE_CACHES_LOCK:
+        if key not in _SAMPLE_CACHES:
+            _SAMPLE_CACHES[key] = SampleCache(path, max_bytes)
+        return _SAMPLE_CACHES[key]
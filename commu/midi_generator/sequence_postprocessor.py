@@ -1,12 +1,95 @@
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List, Tuple
 
-from miditoolkit import MidiFile
+import mido
+from miditoolkit import MidiFile, Note
 
 from commu.midi_generator.container import TransXlInputData
-from commu.preprocessor.encoder import EventSequenceEncoder
+from commu.preprocessor.encoder import EventSequenceEncoder, TOKEN_OFFSET
 from commu.preprocessor.utils.container import MidiInfo
 
+# key numbers of miditoolkit.KeySignature to mido key names
+MIDO_KEY_NAMES = [
+    'C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B',
+    'Cm', 'C#m', 'Dm', 'D#m', 'Em', 'Fm', 'F#m', 'Gm', 'G#m', 'Am', 'Bbm', 'Bm',
+]
+
+# order of the events sharing a tick, as in miditoolkit.MidiFile.dump
+EVENT_ORDER = {
+    'set_tempo': 1,
+    'time_signature': 2,
+    'key_signature': 3,
+    'marker': 4,
+    'program_change': 6,
+    'note_on': 10,
+}
+
+
+def to_mido_file(decoded_midi: MidiFile) -> mido.MidiFile:
+    """
+    convert a midi decoded by EventSequenceEncoder into mido, in memory
+    the result is the same as dumping it with miditoolkit and reading the file back with mido,
+    for the subset of midi written by encoder_utils.write_midi (a single instrument, no pedals nor bends)
+    """
+    def sort_key(message):
+        secondary = EVENT_ORDER[message.type] * 256 * 256
+        if message.type == 'note_on':
+            secondary += message.note * 256 + message.velocity
+        return message.time, secondary
+
+    def to_delta_times(track):
+        tick = 0
+        for message in track:
+            message.time -= tick
+            tick += message.time
+        return track
+
+    meta_track = [
+        mido.MetaMessage(
+            'time_signature', time=ts.time, numerator=ts.numerator, denominator=ts.denominator)
+        for ts in decoded_midi.time_signature_changes
+    ]
+    meta_track += [
+        mido.MetaMessage('set_tempo', time=tempo.time, tempo=mido.bpm2tempo(tempo.tempo))
+        for tempo in decoded_midi.tempo_changes
+    ]
+    meta_track += [
+        mido.MetaMessage('marker', time=marker.time, text=marker.text)
+        for marker in decoded_midi.markers
+    ]
+    meta_track += [
+        mido.MetaMessage('key_signature', time=ks.time, key=MIDO_KEY_NAMES[ks.key_number])
+        for ks in decoded_midi.key_signature_changes
+    ]
+    meta_track.sort(key=sort_key)
+    meta_track.append(mido.MetaMessage('end_of_track', time=meta_track[-1].time + 1))
+
+    instrument, = decoded_midi.instruments
+    channel = 0
+    track = [mido.Message('program_change', time=0, program=instrument.program, channel=channel)]
+    for note in instrument.notes:
+        track.append(mido.Message(
+            'note_on', time=note.start, channel=channel, note=note.pitch, velocity=note.velocity))
+        track.append(mido.Message(
+            'note_on', time=note.end, channel=channel, note=note.pitch, velocity=0))
+    track.sort(key=sort_key)
+    # a note off sharing its tick and pitch with a note on goes first
+    for n, (message1, message2) in enumerate(zip(track[:-1], track[1:])):
+        if (
+            message1.time == message2.time
+            and message1.type == message2.type == 'note_on'
+            and message1.note == message2.note
+            and message1.velocity != 0
+            and message2.velocity == 0
+        ):
+            track[n], track[n + 1] = message2, message1
+    track.append(mido.MetaMessage('end_of_track', time=track[-1].time + 1))
+
+    return mido.MidiFile(
+        ticks_per_beat=decoded_midi.ticks_per_beat,
+        tracks=[mido.MidiTrack(to_delta_times(meta_track)), mido.MidiTrack(to_delta_times(track))],
+    )
+
 
 class PostprocessTask:
     def __init__(self):
@@ -42,6 +125,41 @@ class PostprocessTask:
 
         return decoded_midi
 
+    def decode_bars(
+            self,
+            tokens: Iterable[int],
+            encoded_meta: List[int],
+    ) -> Iterator[Tuple[int, List[Note]]]:
+        """
+        decode a stream of generated tokens bar by bar, e.g. from InferenceTask.stream_tokens
+        yields (bar index, notes of the bar) as soon as a bar is complete, note times are absolute
+        """
+        time_signature = next(
+            token for token in encoded_meta if TOKEN_OFFSET.TS.value <= token < TOKEN_OFFSET.PITCH_RANGE.value
+        )
+        decoder = EventSequenceEncoder()
+        bar_index = 0
+        bar_tokens = []
+        for token in tokens:
+            if token in (TOKEN_OFFSET.BAR.value, TOKEN_OFFSET.EOS.value) and bar_tokens:
+                yield bar_index, decoder.decode_notes(time_signature, bar_tokens, first_bar=bar_index)
+                bar_index += 1
+                bar_tokens = []
+            if token == TOKEN_OFFSET.EOS.value:
+                return
+            bar_tokens.append(token)
+        if bar_tokens:
+            yield bar_index, decoder.decode_notes(time_signature, bar_tokens, first_bar=bar_index)
+
+    def execute_in_memory(self, sequences: List[List[int]], meta_info_len: int) -> List[mido.MidiFile]:
+        """
+        same as execute, but the decoded midis are handed over in memory instead of being written
+        """
+        return [
+            to_mido_file(self.decode_event_sequence(generation_result=seq, num_meta=meta_info_len))
+            for seq in sequences
+        ]
+
     def execute(self, sequences: List[List[int]], meta_info_len: int) -> Path:
         for idx, seq in enumerate(sequences):
             decoded_midi = self.decode_event_sequence(
@@ -0,0 +1,91 @@
+import argparse
+import time
+from typing import List
+
+import torch
+
+from commu.midi_generator.container import TransXlInputData
+from commu.midi_generator.midi_inferrer import InferenceTask, SequenceState
+from commu.model.config_helper import get_default_cfg_inference
+from commu.preprocessor.encoder import TOKEN_OFFSET
+
+
+def benchmark_input_data(num_measures: int) -> TransXlInputData:
+    chords_per_measure = 8
+    num_chords = (num_measures - num_measures % 4) * chords_per_measure
+    return TransXlInputData(
+        bpm=120,
+        audio_key="aminor",
+        time_signature="4/4",
+        pitch_range="mid",
+        num_measures=num_measures,
+        inst="acoustic_piano",
+        genre="newage",
+        min_velocity=60,
+        max_velocity=90,
+        track_role="main_melody",
+        rhythm="standard",
+        output_dir="out",
+        num_generate=1,
+        top_k=32,
+        temperature=1.0,
+        chord_progression=["Am"] * num_chords,
+    )
+
+
+def step_overheads(num_steps: int, window: int, num_measures: int) -> List[float]:
+    """
+    mean time per step, in microseconds, of the bookkeeping of the generation loop over windows of
+    `window` steps: teacher forcing, grammar, sampling, everything but the forward pass
+    bars are never sampled, so that the sequence keeps growing up to `num_steps` tokens
+    """
+    inference_cfg = get_default_cfg_inference()
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = num_steps
+    inference_cfg.freeze()
+    inference_task = InferenceTask(torch.device("cpu"))
+    inference_task.inference_cfg = inference_cfg
+
+    torch.manual_seed(0)
+    logits = torch.randn(num_steps, TOKEN_OFFSET.VOCAB_SIZE.value - 1)
+    logits[:, TOKEN_OFFSET.BAR.value - 1] = -float("inf")
+    logits[:, TOKEN_OFFSET.EOS.value - 1] = -float("inf")
+
+    state = SequenceState([0, TOKEN_OFFSET.BAR.value], benchmark_input_data(num_measures))
+    overheads = []
+    start = time.perf_counter()
+    for step in range(num_steps):
+        if inference_task.next_input_token(state) is None:
+            break
+        state.logits = logits[step].clone()
+        if state.sample_after_forward:
+            inference_task.sample_next_token(state)
+        if (step + 1) % window == 0:
+            overheads.append((time.perf_counter() - start) / window * 1e6)
+            start = time.perf_counter()
+    return overheads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_steps",
+        dest="num_steps",
+        type=int,
+        default=get_default_cfg_inference().GENERATION.generation_length)
+    parser.add_argument(
+        "--window",
+        dest="window",
+        type=int,
+        default=512)
+    parser.add_argument(
+        "--num_measures",
+        dest="num_measures",
+        type=int,
+        default=6)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    overheads = step_overheads(args.num_steps, args.window, args.num_measures)
+    for idx, overhead in enumerate(overheads):
+        print(f"steps {idx * args.window:>5}-{(idx + 1) * args.window:>5}: {overhead:8.1f} us/step")
@@ -0,0 +1,122 @@
+import enum
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from commu.preprocessor.encoder import TOKEN_OFFSET, encoder_utils
+from commu.preprocessor.utils import constants
+
+if TYPE_CHECKING:
+    import torch
+
+
+class GrammarState(enum.IntEnum):
+    """
+    state of the REMI grammar, i.e. the kind of the last token in the sequence
+    """
+    META = 0
+    EOS = 1
+    BAR = 2
+    PITCH = 3
+    NOTE_VELOCITY = 4
+    CHORD = 5
+    NOTE_DURATION = 6
+    POSITION = 7
+
+
+TOKEN_RANGES: Dict[GrammarState, range] = {
+    GrammarState.EOS: range(TOKEN_OFFSET.EOS.value, TOKEN_OFFSET.BAR.value),
+    GrammarState.BAR: range(TOKEN_OFFSET.BAR.value, TOKEN_OFFSET.PITCH.value),
+    GrammarState.PITCH: range(TOKEN_OFFSET.PITCH.value, TOKEN_OFFSET.NOTE_VELOCITY.value),
+    GrammarState.NOTE_VELOCITY: range(TOKEN_OFFSET.NOTE_VELOCITY.value, TOKEN_OFFSET.CHORD_START.value),
+    GrammarState.CHORD: range(TOKEN_OFFSET.CHORD_START.value, TOKEN_OFFSET.CHORD_END.value + 1),
+    GrammarState.NOTE_DURATION: range(TOKEN_OFFSET.NOTE_DURATION.value, TOKEN_OFFSET.POSITION.value),
+    GrammarState.POSITION: range(TOKEN_OFFSET.POSITION.value, TOKEN_OFFSET.BPM.value),
+}
+
+# kinds of token that may be sampled in each state
+# chords are left out on purpose: they are always teacher forced, never sampled
+TRANSITIONS: Dict[GrammarState, Tuple[GrammarState, ...]] = {
+    GrammarState.META: (GrammarState.BAR,),
+    GrammarState.EOS: (GrammarState.EOS,),
+    GrammarState.BAR: (GrammarState.BAR, GrammarState.POSITION),
+    GrammarState.POSITION: (GrammarState.NOTE_VELOCITY,),
+    GrammarState.NOTE_VELOCITY: (GrammarState.PITCH,),
+    GrammarState.PITCH: (GrammarState.NOTE_DURATION,),
+    GrammarState.NOTE_DURATION: (GrammarState.POSITION, GrammarState.BAR, GrammarState.EOS),
+    GrammarState.CHORD: (GrammarState.POSITION, GrammarState.BAR, GrammarState.EOS),
+}
+
+
+class TokenGrammar:
+    def __init__(self, device: Optional["torch.device"] = None):
+        """
+        REMI grammar compiled into a state machine
+        the state only depends on the last token, so that each step is a pair of table lookups:
+        token -> state, and state -> mask of the tokens allowed next
+        masks are torch tensors on `device`, numpy arrays without a device (see NumpyTokenSampler)
+        """
+        if device is None:
+            self.asarray = np.asarray
+        else:
+            # torch is only imported for a device, decoders on numpy arrays run without it
+            import torch
+
+            self.asarray = lambda array: torch.from_numpy(array).to(device)
+
+        vocab_size = TOKEN_OFFSET.VOCAB_SIZE.value
+        self.token_state = np.full(vocab_size, GrammarState.META, dtype=np.int64)
+        for state, tokens in TOKEN_RANGES.items():
+            self.token_state[tokens.start:tokens.stop] = state
+
+        masks = np.zeros((len(GrammarState), vocab_size), dtype=bool)
+        for state, next_states in TRANSITIONS.items():
+            for next_state in next_states:
+                tokens = TOKEN_RANGES[next_state]
+                masks[state, tokens.start:tokens.stop] = True
+        self.masks = self.asarray(masks)
+        self.all_tokens = self.asarray(np.ones(vocab_size, dtype=bool))
+        self._meta_masks: Dict[Tuple[str, int, int, int], Any] = {}
+
+    def state(self, token: int) -> GrammarState:
+        return GrammarState(self.token_state[token])
+
+    def allowed_tokens(self, token: int) -> Any:
+        """
+        boolean mask over the vocabulary of the tokens that may follow `token`
+        """
+        return self.masks[self.token_state[token]]
+
+    def allowed_tokens_batch(self, tokens: List[int]) -> Any:
+        """
+        masks [len(tokens) x vocab_size] of the tokens that may follow each of `tokens`
+        """
+        return self.masks[self.asarray(self.token_state[tokens])]
+
+    def meta_mask(self, pitch_range: str, min_velocity: int, max_velocity: int, pitch_margin: int) -> Any:
+        """
+        boolean mask over the vocabulary that leaves out the pitches far from `pitch_range`
+        and the velocity bins outside [min_velocity, max_velocity], any other token is allowed
+        the pitch range bins the mean pitch of a track, pitches up to `pitch_margin` semitones past the bin are kept
+        """
+        key = (pitch_range, min_velocity, max_velocity, pitch_margin)
+        if key not in self._meta_masks:
+            cuts = list(constants.PITCH_RANGE_CUT.values())
+            idx = list(constants.PITCH_RANGE_CUT).index(pitch_range)
+            low_pitch = max(0, (cuts[idx - 1] if idx > 0 else 0) - pitch_margin)
+            high_pitch = min(127, cuts[idx] - 1 + pitch_margin)
+            # same binning as the encoder, see encoder_utils
+            bins = np.searchsorted(
+                encoder_utils.DEFAULT_VELOCITY_BINS, [min_velocity, max_velocity], side="right"
+            ) - 1
+            low_bin, high_bin = int(bins.min()), int(bins.max())
+
+            mask = np.ones(len(self.token_state), dtype=bool)
+            pitches = TOKEN_RANGES[GrammarState.PITCH]
+            mask[pitches.start:pitches.stop] = False
+            mask[pitches.start + low_pitch:pitches.start + high_pitch + 1] = True
+            velocities = TOKEN_RANGES[GrammarState.NOTE_VELOCITY]
+            mask[velocities.start:velocities.stop] = False
+            mask[velocities.start + low_bin:velocities.start + high_bin + 1] = True
+            self._meta_masks[key] = self.asarray(mask)
+        return self._meta_masks[key]
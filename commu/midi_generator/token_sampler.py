@@ -0,0 +1,78 @@
+from typing import List, Optional
+
+import torch
+
+
+class TokenSampler:
+    def __init__(self, vocab_size: int, device: torch.device):
+        """
+        temperature and top-k sampling of a batch of sequences straight from their logits
+        the next token of each sequence is drawn by inverse transform sampling of its top-k distribution,
+        from a single uniform number per sequence
+        it also makes the tensors InferenceTask decodes with, see NumpyTokenSampler for decoders without torch
+        """
+        self.device = device
+        self.ranks = torch.arange(vocab_size, device=device)
+
+    def tokens(self, tokens: List[List[int]]) -> torch.Tensor:
+        return torch.tensor(tokens, dtype=torch.long, device=self.device)
+
+    def last_logits(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        fp32 logits after the last position of a segment [qlen x bsz x n_token], without the padding token
+        """
+        return logits[-1, :, 1:].float()
+
+    def stack(self, rows: List[torch.Tensor]) -> torch.Tensor:
+        return torch.stack(rows)
+
+    def generator(self, seed: int) -> torch.Generator:
+        return torch.Generator(device=self.device).manual_seed(seed)
+
+    def no_grad(self):
+        return torch.no_grad()
+
+    def uniforms(self, bsz: int, generators: Optional[List[torch.Generator]]) -> torch.Tensor:
+        if generators is None:
+            return torch.rand(bsz, device=self.device)
+        return torch.cat([torch.rand(1, device=self.device, generator=generator) for generator in generators])
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        allowed: torch.Tensor,
+        temperatures: List[float],
+        top_ks: List[int],
+        generators: Optional[List[torch.Generator]] = None,
+    ) -> List[int]:
+        """
+        logits [bsz x n_token - 1] do not include the padding token, allowed [bsz x n_token - 1] masks the
+        tokens that may be sampled, temperature 0 takes the argmax
+        return the sampled tokens, padding token included in the numbering, 0 when nothing could be sampled
+        generators, one per sequence, make the draws of a sequence independent of the rest of the batch,
+        the global torch generator is used without them
+        the masks that a batch does not need (mixed top-k, mixed temperatures, argmax) are skipped,
+        at batch size 1 the cost is dominated by the number of ops
+        """
+        bsz = logits.size(0)
+        max_k = min(max(top_ks), logits.size(1))
+        values, indices = logits.masked_fill(~allowed, -float("inf")).topk(max_k, dim=-1)
+        if min(top_ks) < max_k:
+            top_ks = torch.tensor(top_ks, device=self.device)
+            values.masked_fill_(self.ranks[:max_k] >= top_ks[:, None], -float("inf"))
+        scales = [temperature if temperature > 0 else 1.0 for temperature in temperatures]
+        if len(set(scales)) == 1:
+            values /= scales[0]
+        else:
+            values /= torch.tensor(scales, dtype=values.dtype, device=self.device)[:, None]
+
+        cdf = torch.softmax(values.float(), dim=-1).cumsum_(dim=-1)
+        targets = self.uniforms(bsz, generators).mul_(cdf[:, -1])
+        # the first rank whose cumulated probability exceeds the target, ranks of probability 0 are never picked
+        choices = torch.searchsorted(cdf, targets[:, None], right=True).clamp_(max=max_k - 1)
+        if 0 in temperatures:
+            greedy = torch.tensor([temperature == 0 for temperature in temperatures], device=self.device)
+            choices.masked_fill_(greedy[:, None], 0)
+        # 0 when nothing is allowed, or when the logits are not finite
+        tokens = (indices.gather(1, choices) + 1) * (cdf[:, -1:] > 0)
+        return tokens.view(-1).tolist()
@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# tokens are stored as unsigned 16-bit integers, the vocabulary is far smaller
+TOKEN_TYPECODE = "H"
+
+
+def combination_key(
+    bpm: int,
+    key: str,
+    time_signature: str,
+    num_measures: int,
+    genre: str,
+    rhythm: str,
+    chord_progression: str,
+) -> str:
+    """
+    key of a metadata combination, chord_progression folded as in cfg/metadata.yaml
+    """
+    return json.dumps([bpm, key, time_signature, num_measures, genre, rhythm, chord_progression])
+
+
+def parse_combination_key(combination: str) -> Tuple[int, str, str, int, str, str, str]:
+    return tuple(json.loads(combination))
+
+
+class WarmPool:
+    """
+    SQLite store of generated sequences, ready to be decoded, indexed by metadata combination and track role
+    samples are taken out of the pool when they are used, a builder (see pregenerate.py) refills it
+    the combinations asked for are recorded, so that the most requested ones are refilled first
+    """
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, combination TEXT NOT NULL, "
+            "role TEXT NOT NULL, instrument TEXT NOT NULL, tokens BLOB NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS samples_combination ON samples (combination, role)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS requests "
+            "(combination TEXT PRIMARY KEY, num_requests INTEGER NOT NULL, last_requested REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def count(self, combination: str, role: str) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM samples WHERE combination = ? AND role = ?", (combination, role)
+            ).fetchone()[0]
+
+    def add(self, combination: str, role: str, instrument: str, tokens: List[int]) -> None:
+        blob = array(TOKEN_TYPECODE, tokens).tobytes()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO samples (combination, role, instrument, tokens) VALUES (?, ?, ?, ?)",
+                (combination, role, instrument, blob),
+            )
+
+    def take(self, combination: str, role: str) -> Optional[Tuple[str, List[int]]]:
+        """
+        remove a random sample of the combination and role from the pool
+        return its instrument and tokens, None if the pool has none
+        """
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT id, instrument, tokens FROM samples WHERE combination = ? AND role = ? "
+                    "ORDER BY RANDOM() LIMIT 1",
+                    (combination, role),
+                ).fetchone()
+                if row is not None:
+                    connection.execute("DELETE FROM samples WHERE id = ?", (row[0],))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        tokens = array(TOKEN_TYPECODE)
+        tokens.frombytes(row[2])
+        return row[1], tokens.tolist()
+
+    def record_request(self, combination: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO requests VALUES (?, 1, ?) ON CONFLICT (combination) "
+                "DO UPDATE SET num_requests = num_requests + 1, last_requested = excluded.last_requested",
+                (combination, time.time()),
+            )
+
+    def requested_combinations(self, since: float = 0.0) -> List[str]:
+        """
+        combinations asked for after the `since` timestamp, most requested first
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT combination FROM requests WHERE last_requested > ? "
+                "ORDER BY num_requests DESC, last_requested DESC",
+                (since,),
+            ).fetchall()
+        return [row[0] for row in rows]
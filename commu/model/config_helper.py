@@ -70,11 +70,32 @@ def get_default_cfg_inference():
     cfg.SAMPLING = CN()
     cfg.SAMPLING.threshold = 32.0
     cfg.SAMPLING.temperature = 0.95
+    # seed of the generator of each sequence, derived as seed + sequence number, < 0 uses the global torch generator
+    cfg.SAMPLING.seed = -1
+    # semitones allowed past the mean pitch band of the pitch range, for inputs with meta_constraints
+    cfg.SAMPLING.pitch_margin = 12
 
     # Model related parameters
     cfg.GENERATION = CN()
     cfg.GENERATION.generation_length = 4096
-
+    # candidates decoded together per meta, the first valid ones are kept
+    cfg.GENERATION.num_candidates = 1
+    # byte budget of the cache of decode memories after a conditional prefix, 0 disables it
+    cfg.GENERATION.prefix_cache_bytes = 64 * 1024 ** 2
+    # rollbacks of a failed sequence to its last bar before it is given up, 0 disables them
+    cfg.GENERATION.max_rollbacks = 3
+    # SQLite database of the sequences generated with a fixed SAMPLING.seed, replayed for the same inputs,
+    # an empty path disables it
+    cfg.GENERATION.sample_cache_path = ""
+    # byte budget of the sample cache, least recently used sequences are evicted first
+    cfg.GENERATION.sample_cache_bytes = 256 * 1024 ** 2
+
+    # Generation worker related parameters
+    cfg.SERVING = CN()
+    # sequences decoded together by the worker, candidates included
+    cfg.SERVING.max_batch_size = 32
+    # time an idle worker waits for more requests before it starts decoding a batch
+    cfg.SERVING.max_wait_ms = 10.0
 
     cfg.freeze()
     return cfg
@@ -0,0 +1,266 @@
+import argparse
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from commu.model.model import DecodeMemory, MemTransformerLM
+
+
+def rel_shift(x: torch.Tensor) -> torch.Tensor:
+    # see RelMultiHeadAttn._rel_shift
+    zero_pad = torch.zeros((x.size(0), x.size(1), x.size(2), 1), device=x.device, dtype=x.dtype)
+    x_padded = torch.cat([zero_pad, x], dim=3)
+    x_padded = x_padded.view(x.size(0), x.size(1), x.size(3) + 1, x.size(2))
+    return x_padded[:, :, 1:].view_as(x)
+
+
+class DecodeStepLayer(nn.Module):
+    n_head: torch.jit.Final[int]
+    d_head: torch.jit.Final[int]
+    scale: torch.jit.Final[float]
+
+    def __init__(self, layer):
+        """
+        a RelPartialLearnableDecoderLayer decoding over cached keys and values, its modules are shared
+        """
+        super(DecodeStepLayer, self).__init__()
+        self.n_head = layer.dec_attn.n_head
+        self.d_head = layer.dec_attn.d_head
+        self.scale = layer.dec_attn.scale
+        self.qkv_net = layer.dec_attn.qkv_net
+        self.r_net = layer.dec_attn.r_net
+        self.o_net = layer.dec_attn.o_net
+        self.layer_norm = layer.dec_attn.layer_norm
+        self.pos_ff = layer.pos_ff
+
+    def forward(
+        self,
+        w: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        pos_heads: torch.Tensor,
+        pos_emb: torch.Tensor,
+        r_w_bias: torch.Tensor,
+        r_r_bias: torch.Tensor,
+        attn_mask: Optional[torch.Tensor],
+        start: int,
+        end: int,
+        num_pos_heads: int,
+    ) -> torch.Tensor:
+        qlen = w.size(0)
+        klen = end - start + qlen
+
+        w_head_q, w_head_k, w_head_v = torch.chunk(self.qkv_net(w), 3, dim=-1)
+        keys[end:end + qlen] = w_head_k
+        values[end:end + qlen] = w_head_v
+        if num_pos_heads < klen:
+            pos_heads[num_pos_heads:klen] = self.r_net(pos_emb)
+
+        return self.attend(
+            w, w_head_q, keys[start:end + qlen], values[start:end + qlen], pos_heads[:klen].flip(0),
+            r_w_bias, r_r_bias, attn_mask,
+        )
+
+    def attend(
+        self,
+        w: torch.Tensor,
+        w_head_q: torch.Tensor,
+        w_head_k: torch.Tensor,
+        w_head_v: torch.Tensor,
+        r_head_k: torch.Tensor,
+        r_w_bias: torch.Tensor,
+        r_r_bias: torch.Tensor,
+        attn_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        rest of the layer once the queries, keys, values and position heads of every position are known
+        """
+        qlen, bsz, klen = w.size(0), w.size(1), w_head_k.size(0)
+        w_head_q = w_head_q.view(qlen, bsz, self.n_head, self.d_head)
+        w_head_k = w_head_k.view(klen, bsz, self.n_head, self.d_head)
+        w_head_v = w_head_v.view(klen, bsz, self.n_head, self.d_head)
+        r_head_k = r_head_k.view(klen, self.n_head, self.d_head)
+
+        AC = torch.einsum("ibnd,jbnd->bnij", (w_head_q + r_w_bias, w_head_k))
+        BD = rel_shift(torch.einsum("ibnd,jnd->bnij", (w_head_q + r_r_bias, r_head_k)))
+        attn_score = (AC + BD) * self.scale
+        if attn_mask is not None:
+            attn_score = attn_score.masked_fill(attn_mask[None, None, :, :], -float("inf"))
+        attn_prob = F.softmax(attn_score, dim=3, dtype=torch.float32).to(attn_score.dtype)
+
+        attn_vec = torch.einsum("bnij,jbnd->ibnd", (attn_prob, w_head_v))
+        attn_vec = attn_vec.contiguous().view(qlen, bsz, self.n_head * self.d_head)
+        output = self.layer_norm(w + self.o_net(attn_vec))
+        return self.pos_ff(output)
+
+
+class DecodeStep(nn.Module):
+    n_layer: torch.jit.Final[int]
+    n_head: torch.jit.Final[int]
+    d_head: torch.jit.Final[int]
+    mem_len: torch.jit.Final[int]
+    clamp_len: torch.jit.Final[int]
+    same_length: torch.jit.Final[bool]
+    emb_scale: torch.jit.Final[float]
+
+    def __init__(self, model: MemTransformerLM):
+        """
+        decode step of a MemTransformerLM over the buffers of a DecodeMemory, written for torch.jit.script
+        same computation as forward_generate in eval mode, the memory buffers are written in place
+        """
+        super(DecodeStep, self).__init__()
+        assert model.crit.n_clusters == 0 and model.crit.out_projs[0] is None
+        self.n_layer = model.n_layer
+        self.n_head = model.n_head
+        self.d_head = model.d_head
+        self.mem_len = model.mem_len
+        self.clamp_len = model.clamp_len
+        self.same_length = model.same_length
+        self.emb_scale = model.word_emb.emb_scale
+
+        self.word_emb = model.word_emb.emb_layers[0]
+        self.layers = nn.ModuleList([DecodeStepLayer(layer) for layer in model.layers])
+        self.out_layer = model.crit.out_layers[0]
+        self.r_w_bias = model.r_w_bias
+        self.r_r_bias = model.r_r_bias
+        self.register_buffer("inv_freq", model.pos_emb.inv_freq.clone())
+
+    def _attn_mask(self, qlen: int, klen: int, device: torch.device) -> Optional[torch.Tensor]:
+        # see MemTransformerLM.attention_mask
+        if qlen == 1 and not (self.same_length and klen > self.mem_len):
+            return None
+        query_dist = torch.arange(qlen, 0, -1, device=device)[:, None]
+        key_dist = torch.arange(klen, 0, -1, device=device)[None, :]
+        mask = key_dist < query_dist
+        if self.same_length:
+            mask = mask | (key_dist - query_dist >= self.mem_len)
+        return mask
+
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        pos_heads: torch.Tensor,
+        start: int,
+        end: int,
+        num_pos_heads: int,
+    ) -> torch.Tensor:
+        """
+        feed tokens [qlen x bsz] on top of the window keys[:, start:end] of a DecodeMemory, room for them
+        must be reserved beforehand. return the logits [qlen x bsz x n_token]
+        the keys and values of the tokens are written at end:end + qlen, the r_net projections of the
+        distances num_pos_heads:klen in pos_heads
+        """
+        qlen, bsz = tokens.size(0), tokens.size(1)
+        klen = end - start + qlen
+
+        core_out = self.word_emb(tokens) * self.emb_scale
+
+        pos_emb = core_out.new_empty(0)
+        if num_pos_heads < klen:
+            pos_seq = torch.arange(num_pos_heads, klen, device=tokens.device).to(self.inv_freq.dtype)
+            if self.clamp_len > 0:
+                pos_seq = pos_seq.clamp(max=float(self.clamp_len))
+            sinusoid_inp = torch.ger(pos_seq, self.inv_freq)
+            pos_emb = torch.cat([sinusoid_inp.sin(), sinusoid_inp.cos()], dim=-1).to(core_out.dtype)
+        attn_mask = self._attn_mask(qlen, klen, tokens.device)
+
+        i = 0
+        for layer in self.layers:
+            core_out = layer(
+                core_out, keys[i], values[i], pos_heads[i], pos_emb, self.r_w_bias, self.r_r_bias,
+                attn_mask, start, end, num_pos_heads,
+            )
+            i += 1
+
+        logits = self.out_layer(core_out.view(-1, core_out.size(-1)))
+        return logits.view(qlen, bsz, -1)
+
+
+class ScriptedDecoder:
+    # the exported step has no per-sequence mask, see DecodeMemory.cat
+    ragged_batches = False
+
+    def __init__(self, step: torch.jit.ScriptModule):
+        """
+        drop-in replacement of MemTransformerLM for InferenceTask, running a scripted DecodeStep
+        """
+        self.step = step
+        self.n_layer = step.n_layer
+        self.n_head = step.n_head
+        self.d_head = step.d_head
+        self.mem_len = step.mem_len
+
+    def parameters(self):
+        return self.step.parameters()
+
+    def init_decode_memory(self, bsz):
+        param = next(self.parameters())
+        return DecodeMemory(
+            self.n_layer, self.mem_len, bsz, self.n_head, self.d_head,
+            dtype=param.dtype, device=param.device,
+        )
+
+    def forward_generate(self, data, mems):
+        # the exported step has no per-sequence mask, see DecodeMemory.cat
+        assert mems.num_pad is None, "batches of sequences of different lengths need MemTransformerLM"
+        qlen = data.size(0)
+        mems.reserve(qlen)
+        num_pos_heads = min(mems.num_pos_heads)
+        logits = self.step(data, mems.keys, mems.values, mems.pos_heads, mems.start, mems.end, num_pos_heads)
+        mems.num_pos_heads = [max(num_pos_heads, len(mems) + qlen)] * self.n_layer
+        mems.advance(qlen)
+        return logits, mems
+
+
+def script_decode_step(model: MemTransformerLM) -> torch.jit.ScriptModule:
+    """
+    model must be in eval mode, with the memory length it decodes with (see MemTransformerLM.reset_length)
+    """
+    assert not model.training
+    return torch.jit.script(DecodeStep(model))
+
+
+def save_decode_step(step: torch.jit.ScriptModule, path: str) -> None:
+    torch.jit.save(step, path)
+
+
+def load_decode_step(path: str, device: torch.device) -> ScriptedDecoder:
+    step = torch.jit.load(path, map_location=device)
+    step.eval()
+    return ScriptedDecoder(step)
+
+
+if __name__ == "__main__":
+    from commu.midi_generator.container import ModelArguments
+    from commu.midi_generator.model_initializer import ModelInitializeTask
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        type=str,
+        default="fp32")
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default="ckpt/decode_step.pt")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model_initialize_task = ModelInitializeTask(
+        model_args=ModelArguments(checkpoint_dir=args.checkpoint_dir, precision=args.precision),
+        map_location=device.type,
+        device=device,
+    )
+    model, _ = model_initialize_task.load()
+    save_decode_step(script_decode_step(model), args.output)
@@ -0,0 +1,131 @@
+import argparse
+import json
+import struct
+from pathlib import Path
+from typing import Dict, Union
+
+import torch
+
+from commu.logger import logger
+
+# file layout: MAGIC, header length (little-endian uint64), JSON header, then the tensor data,
+# each tensor starting on an ALIGNMENT boundary so that it can be viewed in place from the mapped file
+MAGIC = b"COMMUFLT"
+ALIGNMENT = 64
+PREFIX = struct.Struct("<8sQ")
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_flat_checkpoint(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def check_state_dict(
+        model: torch.nn.Module,
+        state_dict: Dict[str, torch.Tensor],
+) -> Dict[str, torch.Tensor]:
+    """
+    state_dict restricted to the keys of the model, so that it can be loaded with strict=True
+    missing keys and shape mismatches raise, keys unknown to the model are dropped with a warning
+    """
+    expected = model.state_dict()
+    missing = [key for key in expected if key not in state_dict]
+    if missing:
+        raise KeyError(f"checkpoint is missing {missing}")
+    unexpected = [key for key in state_dict if key not in expected]
+    if unexpected:
+        logger.warning(f"Ignored unexpected checkpoint keys {unexpected}")
+    mismatched = [key for key, value in expected.items() if state_dict[key].shape != value.shape]
+    if mismatched:
+        raise ValueError(f"checkpoint shapes do not match the model for {mismatched}")
+    return {key: state_dict[key] for key in expected}
+
+
+def write_flat_checkpoint(state_dict: Dict[str, torch.Tensor], path: Union[str, Path]) -> None:
+    """
+    tensors sharing their data, e.g. tied weights, are written once and keep sharing it when read
+    """
+    header, offsets, blobs = {}, {}, []
+    offset = 0
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        ref = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if ref not in offsets:
+            offset = _align(offset)
+            offsets[ref] = offset
+            blobs.append((offset, tensor))
+            offset += tensor.numel() * tensor.element_size()
+        header[key] = {
+            "dtype": str(tensor.dtype).split(".")[-1],
+            "shape": list(tensor.shape),
+            "offset": offsets[ref],
+        }
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(PREFIX.size + len(header_bytes))
+    with open(path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, len(header_bytes)))
+        f.write(header_bytes)
+        for blob_offset, tensor in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(tensor.view(-1).view(torch.uint8).numpy())
+        f.truncate(data_start + offset)
+
+
+def read_flat_state_dict(path: Union[str, Path]) -> Dict[str, torch.Tensor]:
+    """
+    state dict whose tensors are views of a private memory map of the file: nothing is read upfront,
+    and the pages are shared through the page cache with every process mapping the same file until written to
+    """
+    with open(path, "rb") as f:
+        magic, header_len = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a flat checkpoint")
+        header = json.loads(f.read(header_len))
+    data_start = _align(PREFIX.size + header_len)
+
+    size = Path(path).stat().st_size
+    data = torch.from_file(str(path), shared=False, size=size, dtype=torch.uint8)
+    state_dict = {}
+    for key, entry in header.items():
+        dtype = getattr(torch, entry["dtype"])
+        numel = 1
+        for dim in entry["shape"]:
+            numel *= dim
+        start = data_start + entry["offset"]
+        nbytes = numel * torch.empty(0, dtype=dtype).element_size()
+        state_dict[key] = data[start:start + nbytes].view(dtype).view(entry["shape"])
+    return state_dict
+
+
+if __name__ == "__main__":
+    from commu.midi_generator.container import ModelArguments
+    from commu.midi_generator.model_initializer import ModelInitializeTask
+    from commu.model.dataset import BaseVocab
+    from commu.model.model import MemTransformerLM
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default="ckpt/checkpoint_best.flat")
+    args = parser.parse_args()
+
+    model_initialize_task = ModelInitializeTask(
+        model_args=ModelArguments(checkpoint_dir=args.checkpoint_dir),
+        map_location="cpu",
+        device=torch.device("cpu"),
+    )
+    model = MemTransformerLM(model_initialize_task.initialize_training_cfg(), BaseVocab())
+    checkpoint = torch.load(args.checkpoint_dir, map_location="cpu")
+    write_flat_checkpoint(check_state_dict(model, checkpoint["model"]), args.output)
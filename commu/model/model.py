@@ -152,6 +152,15 @@ class PositionalEmbedding(nn.Module):
             return pos_emb[:, None, :]
 
 
+class LayerNorm(nn.LayerNorm):
+    """
+    nn.LayerNorm computed in fp32 whatever the dtype of its input, see ModelInitializeTask.cast_model
+    """
+    def forward(self, inp):
+        output = F.layer_norm(inp.float(), self.normalized_shape, self.weight, self.bias, self.eps)
+        return output.to(inp.dtype)
+
+
 class PositionwiseFF(nn.Module):
     def __init__(self, d_model, d_inner, dropout):
         super(PositionwiseFF, self).__init__()
@@ -168,7 +177,7 @@ class PositionwiseFF(nn.Module):
             nn.Dropout(dropout),
         )
 
-        self.layer_norm = nn.LayerNorm(d_model)
+        self.layer_norm = LayerNorm(d_model)
 
 
     def forward(self, inp):
@@ -211,7 +220,7 @@ class RelMultiHeadAttn(nn.Module):
         self.dropatt = nn.Dropout(dropatt)
         self.o_net = nn.Linear(n_head * d_head, d_model, bias=False)
 
-        self.layer_norm = nn.LayerNorm(d_model)
+        self.layer_norm = LayerNorm(d_model)
 
         self.scale = 1 / (d_head ** 0.5)
 
@@ -277,10 +286,17 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
 
         self.r_net = nn.Linear(self.d_model, self.n_head * self.d_head, bias=False)
 
-    def forward(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
+    def forward(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None, cache=None):
         qlen, rlen, bsz = w.size(0), r.size(0), w.size(1)
 
-        if mems is not None:
+        if cache is not None:
+            # incremental decoding: only the new positions are projected, the rest is cached
+            w_heads = self.qkv_net(w)
+            r_head_k = cache.position_heads(self.r_net, r)
+
+            w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
+            w_head_k, w_head_v = cache.extend(w_head_k, w_head_v)
+        elif mems is not None:
             cat = torch.cat([mems, w], 0)
             w_heads = self.qkv_net(cat)
             r_head_k = self.r_net(r)
@@ -333,7 +349,7 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
                 attn_score.masked_fill_(attn_mask[:, None, :, :], -float("inf"))
 
         # [bsz x n_head x qlen x klen]
-        attn_prob = F.softmax(attn_score, dim=3)
+        attn_prob = F.softmax(attn_score, dim=3, dtype=torch.float32).to(attn_score.dtype)
         attn_prob = self.dropatt(attn_prob)
 
         #### compute attention vector
@@ -367,9 +383,9 @@ class RelPartialLearnableDecoderLayer(nn.Module):
             d_model, d_inner, dropout
         )
 
-    def forward(self, dec_inp, r, r_w_bias, r_r_bias, dec_attn_mask=None, mems=None):
+    def forward(self, dec_inp, r, r_w_bias, r_r_bias, dec_attn_mask=None, mems=None, cache=None):
         output = self.dec_attn(
-            dec_inp, r, r_w_bias, r_r_bias, attn_mask=dec_attn_mask, mems=mems
+            dec_inp, r, r_w_bias, r_r_bias, attn_mask=dec_attn_mask, mems=mems, cache=cache
         )
 
         output = self.pos_ff(output)
@@ -420,7 +436,237 @@ class AdaptiveEmbedding(nn.Module):
         return embed
 
 
+class DecodeMemory:
+    def __init__(
+            self,
+            n_layer,
+            mem_len,
+            bsz,
+            n_head,
+            d_head,
+            dtype=None,
+            device=None,
+            extra_len=None,
+            capacity=None,
+    ):
+        """
+        preallocated decode-time memory of the projected keys and values of every layer
+
+        :param mem_len: number of positions kept, as in MemTransformerLM._update_mems
+        :param extra_len: room left past mem_len before the window is compacted to the front
+        :param capacity: number of positions allocated upfront, mem_len + extra_len by default
+        """
+        self.n_layer = n_layer
+        self.mem_len = mem_len
+        self.n_head = n_head
+        self.d_head = d_head
+        self.extra_len = max(1, mem_len // 4) if extra_len is None else extra_len
+        if capacity is None:
+            capacity = mem_len + self.extra_len
+        self.keys = torch.empty(n_layer, capacity, bsz, n_head * d_head, dtype=dtype, device=device)
+        self.values = torch.empty_like(self.keys)
+        # r_net projections of the relative positions, indexed by distance, never fewer than capacity
+        self.pos_heads = torch.empty(n_layer, capacity, n_head * d_head, dtype=dtype, device=device)
+        self.num_pos_heads = [0] * n_layer
+        self.start = 0
+        self.end = 0
+        # leading positions of the window that each batch entry does not own, None if there are none,
+        # see cat: sequences of different lengths are right-aligned and their padding is masked
+        self.num_pad = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def bsz(self):
+        return self.keys.size(2)
+
+    @property
+    def capacity(self):
+        return self.keys.size(1)
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in (self.keys, self.values, self.pos_heads))
+
+    def layer(self, i):
+        return LayerMemory(self, i)
+
+    def clone(self, indices=None, capacity=None):
+        """
+        copy of the memory window, restricted to the given batch entries
+        capacity=len(self) gives a compact copy, e.g. to be stored in a cache
+        """
+        num_pad = self.num_pad
+        if indices is not None and num_pad is not None:
+            num_pad = [num_pad[idx] for idx in indices]
+        # padding that every copied entry has is left out
+        start = self.start + (0 if num_pad is None else min(num_pad))
+        keys, values = self.keys[:, start:self.end], self.values[:, start:self.end]
+        if indices is not None:
+            index = torch.tensor(indices, dtype=torch.long, device=self.keys.device)
+            keys, values = keys.index_select(2, index), values.index_select(2, index)
+        memory = DecodeMemory._from_window(self, keys, values, capacity)
+        if num_pad is not None:
+            memory._set_padding([pad - (start - self.start) for pad in num_pad])
+        return memory
+
+    @staticmethod
+    def cat(memories, capacity=None):
+        """
+        stack memories along the batch dimension
+        memories shorter than the longest one are right-aligned, the positions before them are zeroed
+        and masked (see padding_mask), so that each entry attends to its own positions only
+        """
+        length = max(len(memory) for memory in memories)
+        keys, values, num_pad = [], [], []
+        for memory in memories:
+            memory_keys = memory.keys[:, memory.start:memory.end]
+            memory_values = memory.values[:, memory.start:memory.end]
+            pad = length - len(memory)
+            if pad:
+                zeros = memory_keys.new_zeros(memory.n_layer, pad, *memory_keys.shape[2:])
+                memory_keys = torch.cat([zeros, memory_keys], dim=1)
+                memory_values = torch.cat([zeros, memory_values], dim=1)
+            keys.append(memory_keys)
+            values.append(memory_values)
+            own_pad = [0] * memory.bsz if memory.num_pad is None else memory.num_pad
+            num_pad += [pad + own for own in own_pad]
+        # position heads only depend on the distance, any memory can provide them
+        like = max(memories, key=lambda memory: min(memory.num_pos_heads))
+        memory = DecodeMemory._from_window(like, torch.cat(keys, dim=2), torch.cat(values, dim=2), capacity)
+        memory._set_padding(num_pad)
+        return memory
+
+    @staticmethod
+    def _from_window(like, keys, values, capacity):
+        length = keys.size(1)
+        memory = DecodeMemory(
+            like.n_layer, like.mem_len, keys.size(2), like.n_head, like.d_head,
+            dtype=keys.dtype, device=keys.device, extra_len=like.extra_len, capacity=capacity,
+        )
+        memory.keys[:, :length] = keys
+        memory.values[:, :length] = values
+        num_pos_heads = min(like.num_pos_heads)
+        if num_pos_heads > memory.pos_heads.size(1):
+            # a segment longer than mem_len projects more distances than the window holds positions
+            memory.pos_heads = memory.pos_heads.new_empty(like.n_layer, num_pos_heads, memory.pos_heads.size(2))
+        memory.pos_heads[:, :num_pos_heads] = like.pos_heads[:, :num_pos_heads]
+        memory.num_pos_heads = [num_pos_heads] * like.n_layer
+        memory.end = length
+        return memory
+
+    def reserve(self, qlen):
+        """
+        make room for qlen new positions right after the current window
+        """
+        if self.end + qlen <= self.capacity:
+            return
+        keep = min(len(self), self.mem_len)
+        if keep + qlen > self.capacity:
+            capacity = keep + qlen + self.extra_len
+            keys = self.keys.new_empty(self.n_layer, capacity, *self.keys.shape[2:])
+            values = torch.empty_like(keys)
+            pos_heads = self.pos_heads.new_empty(
+                self.n_layer, max(capacity, self.pos_heads.size(1)), self.pos_heads.size(2))
+            pos_heads[:, :self.pos_heads.size(1)] = self.pos_heads
+            self.pos_heads = pos_heads
+        else:
+            keys, values = self.keys, self.values
+        keys[:, :keep] = self.keys[:, self.end - keep:self.end].clone()
+        values[:, :keep] = self.values[:, self.end - keep:self.end].clone()
+        self.keys, self.values = keys, values
+        self._drop_front(len(self) - keep)
+        self.start, self.end = 0, keep
+
+    def advance(self, qlen):
+        """
+        commit the qlen positions written after the window, dropping the oldest beyond mem_len
+        """
+        self.end += qlen
+        start = max(self.start, self.end - self.mem_len)
+        self._drop_front(start - self.start)
+        self.start = start
+
+    def truncate(self, length):
+        """
+        forget the newest positions so that only `length` of them are kept
+        """
+        assert length <= len(self)
+        self.end = self.start + length
+        if self.num_pad is not None:
+            self._set_padding([min(pad, length) for pad in self.num_pad])
+
+    def select_batch(self, indices):
+        """
+        keep only the given batch entries
+        """
+        index = torch.tensor(indices, dtype=torch.long, device=self.keys.device)
+        self.keys = self.keys.index_select(2, index)
+        self.values = self.values.index_select(2, index)
+        if self.num_pad is not None:
+            num_pad = [self.num_pad[idx] for idx in indices]
+            # padding left by entries that are gone is not needed anymore
+            trim = min(num_pad, default=0)
+            self.start += trim
+            self._set_padding([pad - trim for pad in num_pad])
+
+    def padding_mask(self, qlen):
+        """
+        [bsz x klen] mask of the keys of the window and of qlen new positions that an entry does not own,
+        None without padding
+        """
+        if self.num_pad is None:
+            return None
+        num_pad = torch.tensor(self.num_pad, device=self.keys.device)
+        positions = torch.arange(len(self) + qlen, device=self.keys.device)
+        return positions[None, :] < num_pad[:, None]
+
+    def _drop_front(self, num_dropped):
+        if self.num_pad is not None and num_dropped > 0:
+            self._set_padding([max(pad - num_dropped, 0) for pad in self.num_pad])
+
+    def _set_padding(self, num_pad):
+        self.num_pad = num_pad if any(num_pad) else None
+
+
+class LayerMemory:
+    def __init__(self, memory, i):
+        """
+        handle on the cached keys and values of the i-th layer of a DecodeMemory
+        """
+        self.memory = memory
+        self.i = i
+
+    def extend(self, w_head_k, w_head_v):
+        """
+        write the keys and values of the new positions [qlen x bsz x n_head * d_head]
+        return views of all the cached ones, new positions included [klen x bsz x n_head * d_head]
+        """
+        memory, qlen = self.memory, w_head_k.size(0)
+        memory.keys[self.i, memory.end:memory.end + qlen] = w_head_k
+        memory.values[self.i, memory.end:memory.end + qlen] = w_head_v
+        return (
+            memory.keys[self.i, memory.start:memory.end + qlen],
+            memory.values[self.i, memory.start:memory.end + qlen],
+        )
+
+    def position_heads(self, r_net, r):
+        """
+        r_net(r) for r ordered from distance klen - 1 down to 0, projecting only unseen distances
+        """
+        memory, klen = self.memory, r.size(0)
+        num_cached = memory.num_pos_heads[self.i]
+        if num_cached < klen:
+            memory.pos_heads[self.i, num_cached:klen] = r_net(r[:klen - num_cached, 0].flip(0))
+            memory.num_pos_heads[self.i] = klen
+        return memory.pos_heads[self.i, :klen].flip(0)
+
+
 class MemTransformerLM(nn.Module):
+    # decodes batches of sequences of different lengths, see DecodeMemory.cat
+    ragged_batches = True
+
     def __init__(
             self,
             cfg,
@@ -477,8 +723,7 @@ class MemTransformerLM(nn.Module):
             self.n_token, d_embed, d_model
         )
 
-        for i in range(len(self.crit.out_layers)):
-            self.crit.out_layers[i].weight = self.word_emb.emb_layers[i].weight
+        self.tie_weights()
 
         self.same_length = same_length
         self.clamp_len = clamp_len
@@ -486,6 +731,18 @@ class MemTransformerLM(nn.Module):
         self.detach_mems_grad = True
         self._create_params()
 
+        # pos_emb of distances max_klen - 1 down to 0 and dec_attn_mask templates, built on first use
+        self._pos_emb_table = None
+        self._attn_mask_templates = {}
+
+    def tie_weights(self):
+        """
+        share the embedding weights with the output layers, again after a load_state_dict with assign=True,
+        which assigns each of them its own parameter
+        """
+        for i in range(len(self.crit.out_layers)):
+            self.crit.out_layers[i].weight = self.word_emb.emb_layers[i].weight
+
     def _create_params(self):
         self.pos_emb = PositionalEmbedding(self.d_model)
         self.r_w_bias = nn.Parameter(torch.Tensor(self.n_head, self.d_head))
@@ -495,6 +752,43 @@ class MemTransformerLM(nn.Module):
         self.tgt_len = tgt_len
         self.mem_len = mem_len
 
+    def position_embedding(self, klen, like):
+        """
+        pos_emb of distances klen - 1 down to 0, sliced from a table computed once for up to max_klen positions
+        """
+        table = self._pos_emb_table
+        if table is None or table.size(0) < klen or table.dtype != like.dtype or table.device != like.device:
+            max_klen = max(klen, self.max_klen, self.tgt_len + self.mem_len)
+            # distances and sinusoids in the dtype of inv_freq, fp32 even in reduced precision
+            pos_seq = torch.arange(max_klen - 1, -1, -1.0, device=like.device, dtype=self.pos_emb.inv_freq.dtype)
+            if self.clamp_len > 0:
+                pos_seq.clamp_(max=self.clamp_len)
+            table = self._pos_emb_table = self.pos_emb(pos_seq).to(like.dtype)
+        return table[table.size(0) - klen:]
+
+    def attention_mask(self, qlen, klen, device):
+        """
+        dec_attn_mask sliced from a template cached per (qlen, same_length, mem_len), None if nothing is masked
+        whether a key is masked only depends on its distance to the right edge and on the query,
+        so that the right-aligned template of a qlen covers every klen
+        """
+        if qlen == 1 and not (self.same_length and klen > self.mem_len):
+            return None
+        key = (qlen, self.same_length, self.mem_len)
+        template = self._attn_mask_templates.get(key)
+        if template is None or template.size(1) < klen or template.device != device:
+            width = max(klen, self.mem_len + qlen)
+            # distances to the right edge, from 1 for the last query / key
+            query_dist = torch.arange(qlen, 0, -1, device=device)[:, None]
+            key_dist = torch.arange(width, 0, -1, device=device)[None, :]
+            # keys past the query, as torch.triu(ones, 1 + mlen)
+            template = key_dist < query_dist
+            if self.same_length:
+                # keys mem_len or more before the query, as torch.tril(ones, -mask_shift_len)
+                template |= key_dist - query_dist >= self.mem_len
+            self._attn_mask_templates[key] = template
+        return template[:, template.size(1) - klen:]
+
     def init_mems(self, n_layers):
         if self.mem_len > 0:
             param = next(self.parameters())
@@ -504,6 +798,13 @@ class MemTransformerLM(nn.Module):
         else:
             return None
 
+    def init_decode_memory(self, bsz):
+        param = next(self.parameters())
+        return DecodeMemory(
+            self.n_layer, self.mem_len, bsz, self.n_head, self.d_head,
+            dtype=param.dtype, device=param.device,
+        )
+
     def _update_mems(self, hids, mems, qlen, mlen, reset_mems=None):
 
         # The idea is that randomization from shuffling will have be equivalent to memory resetting
@@ -542,45 +843,28 @@ class MemTransformerLM(nn.Module):
         qlen, bsz = dec_inp.size()[0], dec_inp.size()[1]
         word_emb = self.word_emb(dec_inp)
 
-        mlen = mems[0].size(0) if mems is not None else 0
-        klen = mlen + qlen
-
-        # Generate the mask between query and all the keys
-        if self.same_length:
-            all_ones = word_emb.new_ones(qlen, klen)
-            mask_len = klen - self.mem_len
-            if mask_len > 0:
-                mask_shift_len = qlen - mask_len
-            else:
-                mask_shift_len = qlen
-
-        if reset_mems is None:
-            indices = torch.BoolTensor(dec_inp.shape[1]).fill_(False)
-        else:
-            indices = reset_mems
-
-        if self.same_length:
-            dec_attn_mask = ((
-                                     torch.triu(all_ones, 1 + mlen)
-                                     + torch.tril(all_ones, -mask_shift_len)
-                             ).bool()[
-                             :, :
-                             ]).repeat(len(indices), 1, 1)  # -1
+        decode_memory = mems if isinstance(mems, DecodeMemory) else None
+        if decode_memory is not None:
+            mlen = len(decode_memory)
+            decode_memory.reserve(qlen)
         else:
-            dec_attn_mask = (torch.triu(
-                word_emb.new_ones(qlen, klen), diagonal=1 + mlen
-            ).bool()[:, :]).repeat(len(indices), 1, 1)
-
-        dec_attn_mask[indices, :, :mlen] = 1
+            mlen = mems[0].size(0) if mems is not None else 0
+        klen = mlen + qlen
 
+        dec_attn_mask = self.attention_mask(qlen, klen, word_emb.device)
+        padding_mask = None if decode_memory is None else decode_memory.padding_mask(qlen)
+        if padding_mask is not None:
+            # sequences of different lengths in the same batch, see DecodeMemory.cat
+            padding_mask = padding_mask[:, None, :]
+            dec_attn_mask = padding_mask if dec_attn_mask is None else dec_attn_mask[None] | padding_mask
+        if reset_mems is not None:
+            if dec_attn_mask is None:
+                dec_attn_mask = torch.zeros(qlen, klen, dtype=torch.bool, device=word_emb.device)
+            dec_attn_mask = dec_attn_mask.repeat(len(reset_mems), 1, 1)
+            dec_attn_mask[reset_mems, :, :mlen] = 1
 
         hids = []
-        pos_seq = torch.arange(
-            klen - 1, -1, -1.0, device=word_emb.device, dtype=word_emb.dtype
-        )
-        if self.clamp_len > 0:
-            pos_seq.clamp_(max=self.clamp_len)
-        pos_emb = self.pos_emb(pos_seq)
+        pos_emb = self.position_embedding(klen, word_emb)
 
         core_out = self.drop(word_emb)
         pos_emb = self.drop(pos_emb)
@@ -588,7 +872,10 @@ class MemTransformerLM(nn.Module):
         hids.append(core_out)
 
         for i, layer in enumerate(self.layers):
-            mems_i = None if mems is None else mems[i]
+            if decode_memory is not None:
+                mems_i, cache_i = None, decode_memory.layer(i)
+            else:
+                mems_i, cache_i = None if mems is None else mems[i], None
             core_out = layer(
                 core_out,
                 pos_emb,
@@ -596,15 +883,22 @@ class MemTransformerLM(nn.Module):
                 self.r_r_bias,
                 dec_attn_mask=dec_attn_mask,
                 mems=mems_i,
+                cache=cache_i,
             )
             hids.append(core_out)
         core_out = self.drop(core_out)
 
+        if decode_memory is not None:
+            decode_memory.advance(qlen)
+            return core_out, decode_memory
+
         new_mems = self._update_mems(hids, mems, mlen, qlen, reset_mems)
         return core_out, new_mems
 
     def forward_generate(self, data, mems):
-
+        """
+        mems may be a DecodeMemory, which is then updated in place and returned
+        """
         if mems is None:
             mems = self.init_mems(self.n_layer)
 
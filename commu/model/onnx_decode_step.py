@@ -0,0 +1,138 @@
+import argparse
+import inspect
+
+import torch
+import torch.nn as nn
+
+from commu.model.decode_step import DecodeStep
+from commu.model.model import MemTransformerLM
+from commu.model.onnx_decoder import METADATA_KEYS, memory_names
+
+
+class OnnxDecodeStep(nn.Module):
+    def __init__(self, step: DecodeStep):
+        """
+        DecodeStep with the memory as explicit inputs and outputs, for torch.onnx.export
+        inputs: tokens [qlen x bsz], distances [n_new] without a position head yet, attn_mask [qlen x klen],
+        then keys_i and values_i [mlen x bsz x n_head * d_head], pos_heads_i [klen - n_new x n_head * d_head]
+        of every layer, with klen = mlen + qlen
+        outputs: logits [qlen x bsz x n_token], then new_keys_i and new_values_i [qlen x bsz x n_head * d_head],
+        new_pos_heads_i [n_new x n_head * d_head] of every layer
+        """
+        super(OnnxDecodeStep, self).__init__()
+        self.step = step
+
+    def forward(self, tokens, distances, attn_mask, *memory):
+        step = self.step
+        core_out = step.word_emb(tokens) * step.emb_scale
+
+        pos_seq = distances.to(core_out.dtype)
+        if step.clamp_len > 0:
+            pos_seq = pos_seq.clamp(max=float(step.clamp_len))
+        sinusoid_inp = torch.ger(pos_seq, step.inv_freq)
+        pos_emb = torch.cat([sinusoid_inp.sin(), sinusoid_inp.cos()], dim=-1)
+
+        outputs = []
+        for i, layer in enumerate(step.layers):
+            keys, values, pos_heads = memory[3 * i:3 * i + 3]
+            w_head_q, w_head_k, w_head_v = torch.chunk(layer.qkv_net(core_out), 3, dim=-1)
+            new_pos_heads = layer.r_net(pos_emb)
+            core_out = layer.attend(
+                core_out,
+                w_head_q,
+                torch.cat([keys, w_head_k], dim=0),
+                torch.cat([values, w_head_v], dim=0),
+                torch.cat([pos_heads, new_pos_heads], dim=0).flip(0),
+                step.r_w_bias,
+                step.r_r_bias,
+                attn_mask,
+            )
+            outputs += [w_head_k, w_head_v, new_pos_heads]
+
+        logits = step.out_layer(core_out.view(-1, core_out.size(-1)))
+        return (logits.view(tokens.size(0), tokens.size(1), -1), *outputs)
+
+
+def export_onnx_decode_step(model: MemTransformerLM, path: str) -> None:
+    """
+    model must be in fp32 and eval mode, with the memory length it decodes with (see MemTransformerLM.reset_length)
+    """
+    import onnx
+
+    assert not model.training
+    # the modules are shared with the model, which export would put back in the mode of the wrapper
+    step = DecodeStep(model).eval()
+    n_layer, hidden = step.n_layer, step.n_head * step.d_head
+    qlen, bsz, mlen, num_pos_heads = 2, 2, 3, 4
+    example = [
+        torch.zeros(qlen, bsz, dtype=torch.long),
+        torch.arange(num_pos_heads, mlen + qlen),
+        torch.zeros(qlen, mlen + qlen, dtype=torch.bool),
+    ]
+    for _ in range(n_layer):
+        example += [torch.zeros(mlen, bsz, hidden), torch.zeros(mlen, bsz, hidden), torch.zeros(num_pos_heads, hidden)]
+
+    input_names = ["tokens", "distances", "attn_mask"] + memory_names(n_layer)
+    output_names = ["logits"] + memory_names(n_layer, "new_")
+    dynamic_axes = {
+        "tokens": {0: "qlen", 1: "bsz"},
+        "distances": {0: "n_new"},
+        "attn_mask": {0: "qlen", 1: "klen"},
+        "logits": {0: "qlen", 1: "bsz"},
+    }
+    for i in range(n_layer):
+        dynamic_axes.update({
+            f"keys_{i}": {0: "mlen", 1: "bsz"},
+            f"values_{i}": {0: "mlen", 1: "bsz"},
+            f"pos_heads_{i}": {0: "num_pos_heads"},
+            f"new_keys_{i}": {0: "qlen", 1: "bsz"},
+            f"new_values_{i}": {0: "qlen", 1: "bsz"},
+            f"new_pos_heads_{i}": {0: "n_new"},
+        })
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript-based exporter handles the data-dependent shapes of the memory
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            OnnxDecodeStep(step).eval(),
+            tuple(example),
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            **kwargs,
+        )
+
+    onnx_model = onnx.load(path)
+    for key in METADATA_KEYS:
+        onnx_model.metadata_props.add(key=key, value=str(int(getattr(step, key))))
+    onnx.save(onnx_model, path)
+
+
+if __name__ == "__main__":
+    from commu.midi_generator.container import ModelArguments
+    from commu.midi_generator.model_initializer import ModelInitializeTask
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        default="ckpt/checkpoint_best.pt")
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default="ckpt/decode_step.onnx")
+    args = parser.parse_args()
+
+    model_initialize_task = ModelInitializeTask(
+        model_args=ModelArguments(checkpoint_dir=args.checkpoint_dir),
+        map_location="cpu",
+        device=torch.device("cpu"),
+    )
+    model, _ = model_initialize_task.load()
+    export_onnx_decode_step(model, args.output)
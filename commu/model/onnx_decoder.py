@@ -0,0 +1,204 @@
+from typing import Dict, List
+
+import numpy as np
+
+# model hyperparameters stored in the metadata of the exported graph
+METADATA_KEYS = ("n_layer", "n_head", "d_head", "mem_len", "clamp_len", "same_length")
+
+
+def memory_names(n_layer: int, prefix: str = "") -> List[str]:
+    return [f"{prefix}{name}_{i}" for i in range(n_layer) for name in ("keys", "values", "pos_heads")]
+
+
+class NumpyDecodeMemory:
+    def __init__(self, n_layer, mem_len, bsz, n_head, d_head, dtype=np.float32, extra_len=None, capacity=None):
+        """
+        DecodeMemory on numpy arrays, for OnnxDecoder
+        every batch entry owns the whole window: the exported step has no padding mask, so that memories
+        of different lengths cannot be stacked (see cat)
+        """
+        self.n_layer = n_layer
+        self.mem_len = mem_len
+        self.n_head = n_head
+        self.d_head = d_head
+        self.extra_len = max(1, mem_len // 4) if extra_len is None else extra_len
+        if capacity is None:
+            capacity = mem_len + self.extra_len
+        self.keys = np.empty((n_layer, capacity, bsz, n_head * d_head), dtype=dtype)
+        self.values = np.empty_like(self.keys)
+        # r_net projections of the relative positions, indexed by distance, never fewer than capacity
+        self.pos_heads = np.empty((n_layer, capacity, n_head * d_head), dtype=dtype)
+        self.num_pos_heads = [0] * n_layer
+        self.start = 0
+        self.end = 0
+        self.num_pad = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def bsz(self):
+        return self.keys.shape[2]
+
+    @property
+    def capacity(self):
+        return self.keys.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.values.nbytes + self.pos_heads.nbytes
+
+    def clone(self, indices=None, capacity=None):
+        """
+        copy of the memory window, restricted to the given batch entries
+        capacity=len(self) gives a compact copy, e.g. to be stored in a cache
+        """
+        keys, values = self.keys[:, self.start:self.end], self.values[:, self.start:self.end]
+        if indices is not None:
+            keys, values = keys[:, :, indices], values[:, :, indices]
+        return NumpyDecodeMemory._from_window(self, keys, values, capacity)
+
+    @staticmethod
+    def cat(memories, capacity=None):
+        """
+        stack memories of the same length along the batch dimension
+        """
+        assert len({len(memory) for memory in memories}) == 1, \
+            "batches of sequences of different lengths need MemTransformerLM"
+        keys = np.concatenate([memory.keys[:, memory.start:memory.end] for memory in memories], axis=2)
+        values = np.concatenate([memory.values[:, memory.start:memory.end] for memory in memories], axis=2)
+        # position heads only depend on the distance, any memory can provide them
+        like = max(memories, key=lambda memory: min(memory.num_pos_heads))
+        return NumpyDecodeMemory._from_window(like, keys, values, capacity)
+
+    @staticmethod
+    def _from_window(like, keys, values, capacity):
+        length = keys.shape[1]
+        memory = NumpyDecodeMemory(
+            like.n_layer, like.mem_len, keys.shape[2], like.n_head, like.d_head,
+            dtype=keys.dtype, extra_len=like.extra_len, capacity=capacity,
+        )
+        memory.keys[:, :length] = keys
+        memory.values[:, :length] = values
+        num_pos_heads = min(like.num_pos_heads)
+        if num_pos_heads > memory.pos_heads.shape[1]:
+            # a segment longer than mem_len projects more distances than the window holds positions
+            memory.pos_heads = np.empty((like.n_layer, num_pos_heads, memory.pos_heads.shape[2]), dtype=keys.dtype)
+        memory.pos_heads[:, :num_pos_heads] = like.pos_heads[:, :num_pos_heads]
+        memory.num_pos_heads = [num_pos_heads] * like.n_layer
+        memory.end = length
+        return memory
+
+    def reserve(self, qlen):
+        """
+        make room for qlen new positions right after the current window
+        """
+        if self.end + qlen <= self.capacity:
+            return
+        keep = min(len(self), self.mem_len)
+        if keep + qlen > self.capacity:
+            capacity = keep + qlen + self.extra_len
+            keys = np.empty((self.n_layer, capacity, *self.keys.shape[2:]), dtype=self.keys.dtype)
+            values = np.empty_like(keys)
+            pos_heads = np.empty(
+                (self.n_layer, max(capacity, self.pos_heads.shape[1]), self.pos_heads.shape[2]),
+                dtype=self.pos_heads.dtype)
+            pos_heads[:, :self.pos_heads.shape[1]] = self.pos_heads
+            self.pos_heads = pos_heads
+        else:
+            keys, values = self.keys, self.values
+        keys[:, :keep] = self.keys[:, self.end - keep:self.end].copy()
+        values[:, :keep] = self.values[:, self.end - keep:self.end].copy()
+        self.keys, self.values = keys, values
+        self.start, self.end = 0, keep
+
+    def advance(self, qlen):
+        """
+        commit the qlen positions written after the window, dropping the oldest beyond mem_len
+        """
+        self.end += qlen
+        self.start = max(self.start, self.end - self.mem_len)
+
+    def truncate(self, length):
+        """
+        forget the newest positions so that only `length` of them are kept
+        """
+        assert length <= len(self)
+        self.end = self.start + length
+
+    def select_batch(self, indices):
+        """
+        keep only the given batch entries
+        """
+        self.keys = self.keys[:, :, indices]
+        self.values = self.values[:, :, indices]
+
+
+class OnnxDecoder:
+    # the exported step has no per-sequence mask, see NumpyDecodeMemory
+    ragged_batches = False
+
+    def __init__(self, session, path: str):
+        """
+        drop-in replacement of MemTransformerLM for InferenceTask, running an exported OnnxDecodeStep
+        with onnxruntime. the memory is a NumpyDecodeMemory and the logits are numpy arrays, sampled by an
+        InferenceTask without a device: a process decoding with it needs neither torch nor the checkpoint
+        the exported step has no padding mask, InferenceTask never batches sequences of different lengths with it
+        and GenerationWorker refuses it
+        """
+        self.session = session
+        self.path = path
+        metadata: Dict[str, str] = session.get_modelmeta().custom_metadata_map
+        self.n_layer = int(metadata["n_layer"])
+        self.n_head = int(metadata["n_head"])
+        self.d_head = int(metadata["d_head"])
+        self.mem_len = int(metadata["mem_len"])
+        self.same_length = bool(int(metadata["same_length"]))
+        self.input_names = ["tokens", "distances", "attn_mask"] + memory_names(self.n_layer)
+
+    def init_decode_memory(self, bsz):
+        return NumpyDecodeMemory(self.n_layer, self.mem_len, bsz, self.n_head, self.d_head)
+
+    def attention_mask(self, qlen: int, klen: int) -> np.ndarray:
+        # see MemTransformerLM.attention_mask, nothing is masked when it returns None
+        query_dist = np.arange(qlen, 0, -1)[:, None]
+        key_dist = np.arange(klen, 0, -1)[None, :]
+        mask = key_dist < query_dist
+        if self.same_length:
+            mask |= key_dist - query_dist >= self.mem_len
+        return mask
+
+    def forward_generate(self, data, mems):
+        assert mems.num_pad is None, "batches of sequences of different lengths need MemTransformerLM"
+        qlen = data.shape[0]
+        mems.reserve(qlen)
+        klen = len(mems) + qlen
+        # at least the farthest position head is recomputed: onnxruntime crashes on empty distances
+        num_pos_heads = min(min(mems.num_pos_heads), klen - 1)
+
+        feeds = {
+            "tokens": data,
+            "distances": np.arange(num_pos_heads, klen, dtype=np.int64),
+            "attn_mask": self.attention_mask(qlen, klen),
+        }
+        for i in range(self.n_layer):
+            feeds[f"keys_{i}"] = mems.keys[i, mems.start:mems.end]
+            feeds[f"values_{i}"] = mems.values[i, mems.start:mems.end]
+            feeds[f"pos_heads_{i}"] = mems.pos_heads[i, :num_pos_heads]
+        logits, *outputs = self.session.run(None, feeds)
+
+        for i in range(self.n_layer):
+            new_keys, new_values, new_pos_heads = outputs[3 * i:3 * i + 3]
+            mems.keys[i, mems.end:mems.end + qlen] = new_keys
+            mems.values[i, mems.end:mems.end + qlen] = new_values
+            mems.pos_heads[i, num_pos_heads:klen] = new_pos_heads
+        mems.num_pos_heads = [max(n, klen) for n in mems.num_pos_heads]
+        mems.advance(qlen)
+        return logits, mems
+
+
+def load_onnx_decode_step(path: str) -> OnnxDecoder:
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    return OnnxDecoder(session, path)
@@ -68,11 +68,7 @@ class EventSequenceEncoder:
         words.append(TOKEN_OFFSET.EOS.value)  # eos token
         return np.array(words)
 
-    def decode(
-        self,
-        midi_info,
-    ):
-        time_sig_word = midi_info.time_signature
+    def get_bar_grid(self, time_sig_word):
         time_sig = SIG_TIME_MAP[time_sig_word - TOKEN_OFFSET.TS.value - 1]
         numerator = int(time_sig.split("/")[0])
         denominator = int(time_sig.split("/")[1])
@@ -86,6 +82,26 @@ class EventSequenceEncoder:
             int(ticks_per_bar / self.position_resolution),
             dtype=int,
         )
+        return duration_bins, beats_per_bar
+
+    def decode_notes(
+        self,
+        time_sig_word,
+        event_seq,
+        first_bar=0,
+    ):
+        """
+        notes of a slice of an event sequence, e.g. a single bar, without writing a midi
+        """
+        duration_bins, beats_per_bar = self.get_bar_grid(time_sig_word)
+        events = encoder_utils.word_to_event(event_seq, self.word2event)
+        return encoder_utils.extract_notes(events, duration_bins, beats_per_bar, first_bar=first_bar)
+
+    def decode(
+        self,
+        midi_info,
+    ):
+        duration_bins, beats_per_bar = self.get_bar_grid(midi_info.time_signature)
 
         decoded_midi = encoder_utils.write_midi(
             midi_info,
@@ -382,20 +382,16 @@ def word_to_event(words, word2event):
         events.append(Event(event_name, None, event_value, None))
     return events
 
-def write_midi(
-    midi_info,
-    word2event,
-    duration_bins,
-    beats_per_bar,
-):
-    events = word_to_event(midi_info.event_seq, word2event)
+def extract_notes(events, duration_bins, beats_per_bar, first_bar=0):
+    """
+    notes of a sequence of events, each bar event past the first one starts a new bar
+    with `first_bar`, the events are a slice of a longer sequence starting at that bar
+    """
     # get downbeat and note (no time)
     temp_notes = []
-    temp_chords = []
     for i in range(len(events) - 3):
         if events[i].name == "Bar" and i > 0:
             temp_notes.append("Bar")
-            temp_chords.append("Bar")
         elif (
             events[i].name == "Position"
             and events[i + 1].name == "Note Velocity"
@@ -414,14 +410,11 @@ def write_midi(
             duration = duration_bins[index]
             # adding
             temp_notes.append([position, velocity, pitch, duration])
-        elif events[i].name == "Position" and events[i + 1].name == "Chord":
-            position = int(events[i].value.split("/")[0]) - 1
-            temp_chords.append([position, events[i + 1].value])
     # get specific time for notes
     ticks_per_beat = DEFAULT_TICKS_PER_BEAT
     ticks_per_bar = ticks_per_beat * beats_per_bar
     notes = []
-    current_bar = 0
+    current_bar = first_bar
     for note in temp_notes:
         if note == "Bar":
             current_bar += 1
@@ -441,7 +434,28 @@ def write_midi(
             # duration (end time)
             et = st + duration
             notes.append(miditoolkit.Note(velocity, pitch, st, et))
+    return notes
+
+
+def write_midi(
+    midi_info,
+    word2event,
+    duration_bins,
+    beats_per_bar,
+):
+    events = word_to_event(midi_info.event_seq, word2event)
+    notes = extract_notes(events, duration_bins, beats_per_bar)
+    # get downbeat and chord (no time)
+    temp_chords = []
+    for i in range(len(events) - 3):
+        if events[i].name == "Bar" and i > 0:
+            temp_chords.append("Bar")
+        elif events[i].name == "Position" and events[i + 1].name == "Chord":
+            position = int(events[i].value.split("/")[0]) - 1
+            temp_chords.append([position, events[i + 1].value])
     # get specific time for chords
+    ticks_per_beat = DEFAULT_TICKS_PER_BEAT
+    ticks_per_bar = ticks_per_beat * beats_per_bar
     if len(temp_chords) > 0:
         chords = []
         current_bar = 0
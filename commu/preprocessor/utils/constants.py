@@ -91,6 +91,17 @@ PITCH_RANGE_MAP = {
     "very_high": 6,
 }
 
+# the pitch range of a track bins its mean pitch, upper bounds (exclusive) of each bin
+PITCH_RANGE_CUT = {
+    "very_low": 36,
+    "low": 48,
+    "mid_low": 60,
+    "mid": 72,
+    "mid_high": 84,
+    "high": 96,
+    "very_high": 128,
+}
+
 INST_MAP = {
     "accordion": 1,
     "acoustic_bass": 3,
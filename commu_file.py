@@ -15,6 +15,14 @@ class CommuFile(MidiFile):
         super().__init__(filepath)
         self._preprocess(name, instrument)
 
+    @classmethod
+    def from_midi(cls, midi: MidiFile, name: str, instrument: str) -> CommuFile:
+        """Build a CommuFile from a MidiFile already in memory, e.g. a freshly generated one."""
+        commu_file = cls.__new__(cls)
+        MidiFile.__init__(commu_file, ticks_per_beat=midi.ticks_per_beat, tracks=midi.tracks)
+        commu_file._preprocess(name, instrument)
+        return commu_file
+
     @property
     def track(self) -> MidiTrack:
         assert len(self.tracks) == 1
@@ -1,15 +1,105 @@
 from collections import defaultdict
-from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import yaml
 from tqdm import tqdm
 
 from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+from commu.midi_generator.generation_pool import get_generation_pool
+from commu.midi_generator.sequence_postprocessor import PostprocessTask
+from commu.midi_generator.warm_pool import WarmPool, combination_key
+from commu.preprocessor.utils.container import MidiMeta
 from commu_dset import DSET
 from commu_file import CommuFile
 
 
+def load_cfg() -> Dict[str, Any]:
+    with open('cfg/inference.yaml') as f:
+        return yaml.safe_load(f)
+
+
+def encode_role(
+        cfg: Dict[str, Any],
+        role: str,
+        bpm: int,
+        key: str,
+        time_signature: str,
+        num_measures: int,
+        genre: str,
+        rhythm: str,
+        chord_progression: str,
+        output_dir: str) -> Tuple[MidiGenerationPipeline, str, List[int]]:
+    pipeline = MidiGenerationPipeline({
+        'checkpoint_dir': cfg['checkpoint'],
+        'precision': cfg['precision'],
+        'decode_step': cfg['decode_step'],
+        'onnx_decode_step': cfg['onnx_decode_step']})
+
+    min_v, max_v = DSET.sample_min_max_velocity(role)
+    instrument = DSET.sample_instrument(role)
+    encoded_meta = pipeline.preprocess_task.excecute({
+        'track_role': role,
+
+        'bpm': bpm,
+        'audio_key': key,
+        'time_signature': time_signature,
+        'num_measures': num_measures,
+        'genre': genre,
+        'rhythm': rhythm,
+        'chord_progression': DSET.unfold(chord_progression),
+
+        'pitch_range': DSET.sample_pitch_range(role),
+        'inst': instrument,
+        'min_velocity': min_v,
+        'max_velocity': max_v,
+
+        'top_k': cfg['top_k'],
+        'temperature': cfg['temperature'],
+        'meta_constraints': cfg['meta_constraints'],
+
+        'output_dir': output_dir,
+        'num_generate': 1})
+
+    return pipeline, instrument, encoded_meta
+
+
+def generate_sequences(
+        cfg: Dict[str, Any],
+        pipelines: List[MidiGenerationPipeline],
+        encoded_metas: List[List[int]],
+        progress: bool = False,
+        seed: Optional[int] = None) -> List[List[List[int]]]:
+    # the checkpoint is loaded on the first call only, then served from the model registry
+    pipeline = pipelines[0]
+    model = pipeline.model_initialize_task.execute()
+    inference_cfg = pipeline.model_initialize_task.inference_cfg
+    if seed is not None:
+        # overrides SAMPLING.seed, e.g. -1 for new draws on every call
+        inference_cfg = inference_cfg.clone()
+        inference_cfg.defrost()
+        inference_cfg.SAMPLING.seed = seed
+        inference_cfg.freeze()
+
+    input_data = [pipeline.preprocess_task.input_data for pipeline in pipelines]
+    if cfg['num_workers'] > 0:
+        # metas are decoded in parallel, one per worker process sharing the model
+        pool = get_generation_pool(model, inference_cfg, cfg['num_workers'], cfg['threads_per_worker'])
+        jobs = [([meta], [data], cfg['num_candidates']) for meta, data in zip(encoded_metas, input_data)]
+        results = [pool.submit(job) for job in jobs]
+        return [result.get()[0] for result in tqdm(results, disable=not progress)]
+
+    # all metas are decoded together, as a single batch
+    pipeline.inference_task(model=model, input_data=input_data[0], inference_cfg=inference_cfg)
+    return pipeline.inference_task.execute_batch(
+        encoded_metas, input_data, num_candidates=cfg['num_candidates'], progress=progress)
+
+
+def decode_sequences(sequences: List[List[int]], role: str, instrument: str) -> List[CommuFile]:
+    # decoded midis are handed over in memory, nothing is written to out/
+    midis = PostprocessTask().execute_in_memory(sequences=sequences, meta_info_len=len(MidiMeta.__fields__))
+    return [CommuFile.from_midi(midi, role, instrument) for midi in midis]
+
+
 def make_midis(
         bpm: int,
         key: str,
@@ -19,52 +109,50 @@ def make_midis(
         rhythm: str,
         chord_progression: str,
         timestamp: str) -> Dict[str, List[CommuFile]]:
-    with open('cfg/inference.yaml') as f:
-        cfg = yaml.safe_load(f)
+    cfg = load_cfg()
+    roles = DSET.get_track_roles()
+    role_to_sample = {}
+
+    if cfg['warm_pool']:
+        # pregenerated samples are used when the pool has some, the other roles are generated live
+        warm_pool = WarmPool(cfg['warm_pool'])
+        combination = combination_key(bpm, key, time_signature, num_measures, genre, rhythm, chord_progression)
+        warm_pool.record_request(combination)
+        for role in roles:
+            sample = warm_pool.take(combination, role)
+            if sample is not None:
+                instrument, tokens = sample
+                role_to_sample[role] = (instrument, [tokens])
+
+    live_roles = [role for role in roles if role not in role_to_sample]
+    if live_roles:
+        pipelines = []
+        role_to_instrument = {}
+        encoded_metas = []
+        for role in live_roles:
+            pipeline, instrument, encoded_meta = encode_role(
+                cfg,
+                role,
+                bpm,
+                key,
+                time_signature,
+                num_measures,
+                genre,
+                rhythm,
+                chord_progression,
+                f'out/{timestamp}')
+            pipelines.append(pipeline)
+            encoded_metas.append(encoded_meta)
+            role_to_instrument[role] = instrument
+
+        # all live track roles are decoded together
+        role_sequences = generate_sequences(cfg, pipelines, encoded_metas, progress=True)
+        for role, sequences in zip(live_roles, role_sequences):
+            role_to_sample[role] = (role_to_instrument[role], sequences)
 
     role_to_midis = defaultdict(list)
-     
-    for role in tqdm(DSET.get_track_roles()):
-
-        pipeline = MidiGenerationPipeline({'checkpoint_dir': 'ckpt/checkpoint_best.pt'})
-
-        inference_cfg = pipeline.model_initialize_task.inference_cfg
-        model = pipeline.model_initialize_task.execute()
-    
-        min_v, max_v = DSET.sample_min_max_velocity(role)
-        instrument = DSET.sample_instrument(role)
-        encoded_meta = pipeline.preprocess_task.excecute({
-            'track_role': role,
-
-            'bpm': bpm,
-            'audio_key': key,
-            'time_signature': time_signature,
-            'num_measures': num_measures,
-            'genre': genre,
-            'rhythm': rhythm,
-            'chord_progression': DSET.unfold(chord_progression),
-            
-            'pitch_range': DSET.sample_pitch_range(role),
-            'inst': instrument,
-            'min_velocity': min_v,
-            'max_velocity': max_v,
-            
-            'top_k': cfg['top_k'],
-            'temperature': cfg['temperature'],
-            
-            'output_dir': f'out/{timestamp}',
-            'num_generate': 1})
-        input_data = pipeline.preprocess_task.input_data
-        meta_info_len = pipeline.preprocess_task.get_meta_info_length()
-
-        pipeline.inference_task(model=model, input_data=input_data, inference_cfg=inference_cfg)
-        sequences = pipeline.inference_task.execute(encoded_meta)
-
-        pipeline.postprocess_task(input_data=input_data)
-        pipeline.postprocess_task.execute(sequences=sequences, meta_info_len=meta_info_len)
-
-        filepath = f'out/{timestamp}/{role}.mid'
-        role_to_midis[role].append(CommuFile(filepath, role, instrument))
-        Path(filepath).unlink()
+    for role in roles:
+        instrument, sequences = role_to_sample[role]
+        role_to_midis[role] += decode_sequences(sequences, role, instrument)
 
     return role_to_midis
@@ -0,0 +1,147 @@
+import argparse
+import os
+import time
+from fractions import Fraction
+from itertools import product
+from typing import Any, Dict, Iterator, List, Tuple
+
+import yaml
+
+from commu.logger import logger
+from commu.midi_generator.warm_pool import WarmPool, combination_key, parse_combination_key
+from commu_dset import DSET
+from commu_wrapper import encode_role, generate_sequences, load_cfg
+
+
+def iter_combinations(meta: Dict[str, List[Any]]) -> Iterator[str]:
+    # only the combinations whose chord progression spans the complete bars, see TransXlInputData
+    for chord_progression, time_signature, num_measures in product(
+            meta['chord_progression'], meta['time_signature'], meta['num_measures']):
+        num_chords = len(DSET.unfold(chord_progression).split('-'))
+        if num_chords != (num_measures - num_measures % 4) * Fraction(time_signature) * 8:
+            continue
+        for bpm, key, genre, rhythm in product(meta['bpm'], meta['key'], meta['genre'], meta['rhythm']):
+            yield combination_key(bpm, key, time_signature, num_measures, genre, rhythm, chord_progression)
+
+
+def refill(
+        cfg: Dict[str, Any],
+        warm_pool: WarmPool,
+        combination: str,
+        samples_per_role: int,
+        low_watermark: int) -> int:
+    # the roles left with fewer than low_watermark samples are topped up to samples_per_role, in one batch
+    bpm, key, time_signature, num_measures, genre, rhythm, chord_progression = parse_combination_key(combination)
+    roles, pipelines, instruments, encoded_metas = [], [], [], []
+    for role in DSET.get_track_roles():
+        num_samples = warm_pool.count(combination, role)
+        if num_samples >= low_watermark:
+            continue
+        for _ in range(samples_per_role - num_samples):
+            pipeline, instrument, encoded_meta = encode_role(
+                cfg,
+                role,
+                bpm,
+                key,
+                time_signature,
+                num_measures,
+                genre,
+                rhythm,
+                chord_progression,
+                'out/warm_pool')
+            roles.append(role)
+            pipelines.append(pipeline)
+            instruments.append(instrument)
+            encoded_metas.append(encoded_meta)
+    if not roles:
+        return 0
+
+    # every sample is a new draw: with a fixed seed, the samples of a meta would all be the same sequence,
+    # replayed from the sample cache
+    role_sequences = generate_sequences(cfg, pipelines, encoded_metas, seed=-1)
+    for role, instrument, sequences in zip(roles, instruments, role_sequences):
+        for sequence in sequences:
+            warm_pool.add(combination, role, instrument, sequence)
+    return len(roles)
+
+
+def build(
+        cfg: Dict[str, Any],
+        warm_pool: WarmPool,
+        meta: Dict[str, List[Any]],
+        samples_per_role: int,
+        low_watermark: int,
+        max_combinations: int,
+        last_checked: float = 0.0) -> Tuple[int, float]:
+    # one walk over the combinations, the ones asked for by make_midis since last_checked are refilled first
+    # the time of the last check is returned, for the next walk to carry on from it
+    num_generated = 0
+    for num_visited, combination in enumerate(iter_combinations(meta)):
+        if max_combinations and num_visited >= max_combinations:
+            break
+        checked = time.time()
+        requested = warm_pool.requested_combinations(since=last_checked)
+        last_checked = checked
+        for target in requested + [combination]:
+            num_samples = refill(cfg, warm_pool, target, samples_per_role, low_watermark)
+            if num_samples:
+                logger.info(f'Pregenerated {num_samples} samples for {target}')
+            num_generated += num_samples
+    return num_generated, last_checked
+
+
+if __name__ == '__main__':
+    cfg = load_cfg()
+    with open('cfg/metadata.yaml') as f:
+        meta = yaml.safe_load(f)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--pool',
+        dest='pool',
+        type=str,
+        default=cfg['warm_pool'] or 'out/warm_pool.sqlite3')
+    parser.add_argument(
+        '--samples_per_role',
+        dest='samples_per_role',
+        type=int,
+        default=4)
+    parser.add_argument(
+        '--low_watermark',
+        dest='low_watermark',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--max_combinations',
+        dest='max_combinations',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--loop',
+        dest='loop',
+        default=False,
+        action='store_true')
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        type=float,
+        default=60.0)
+    parser.add_argument(
+        '--nice',
+        dest='nice',
+        type=int,
+        default=19)
+    args = parser.parse_args()
+    assert 0 < args.low_watermark <= args.samples_per_role
+
+    # pregeneration only gets the CPU time that interactive generation leaves idle
+    os.nice(args.nice)
+    warm_pool = WarmPool(args.pool)
+    last_checked = 0.0
+    while True:
+        num_generated, last_checked = build(
+            cfg, warm_pool, meta, args.samples_per_role, args.low_watermark, args.max_combinations, last_checked)
+        logger.info(f'{num_generated} samples pregenerated, {len(warm_pool)} in the pool')
+        if not args.loop:
+            break
+        time.sleep(args.interval)
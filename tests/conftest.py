@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from commu.midi_generator.info_preprocessor import PreprocessTask
+from commu.midi_generator.midi_inferrer import InferenceTask
+from commu.model.config_helper import get_default_cfg_inference, get_default_cfg_training
+from commu.model.dataset import BaseVocab
+from commu.model.model import MemTransformerLM
+
+MEM_LEN = 30
+
+
+def small_training_cfg():
+    cfg = get_default_cfg_training().clone()
+    cfg.defrost()
+    cfg.MODEL.num_layers = 2
+    cfg.MODEL.num_heads = 2
+    cfg.MODEL.units = 16
+    cfg.MODEL.inner_size = 32
+    cfg.MODEL.same_length = True
+    cfg.freeze()
+    return cfg
+
+
+@pytest.fixture
+def model():
+    """
+    small MemTransformerLM with random weights and a short memory, so that decoding goes past mem_len
+    """
+    torch.manual_seed(0)
+    model = MemTransformerLM(small_training_cfg(), BaseVocab())
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.05)
+    model.eval()
+    model.reset_length(1, MEM_LEN)
+    return model
+
+
+@pytest.fixture
+def inference_cfg():
+    cfg = get_default_cfg_inference().clone()
+    cfg.defrost()
+    cfg.MODEL.memory_length = MEM_LEN
+    cfg.SAMPLING.seed = 0
+    cfg.GENERATION.generation_length = 80
+    cfg.freeze()
+    return cfg
+
+
+def make_meta(track_role="main_melody", **kwargs):
+    """
+    input of PreprocessTask.excecute
+    """
+    meta = {
+        "track_role": track_role,
+        "bpm": 120,
+        "audio_key": "aminor",
+        "time_signature": "4/4",
+        "num_measures": 4,
+        "genre": "newage",
+        "rhythm": "standard",
+        "chord_progression": "-".join(chord for chord in ["Am", "C", "G", "D"] for _ in range(8)),
+        "pitch_range": "mid",
+        "inst": "acoustic_piano",
+        "min_velocity": 60,
+        "max_velocity": 80,
+        "top_k": 32,
+        "temperature": 0.95,
+        "output_dir": "out/tests",
+        "num_generate": 1,
+    }
+    meta.update(kwargs)
+    return meta
+
+
+def make_task(model, inference_cfg, track_roles, device=torch.device("cpu"), **kwargs):
+    """
+    inference task set up with the model, and the encoded metas and input data of the track roles
+    kwargs override the meta of every track role (see make_meta)
+    """
+    encoded_metas, input_data = [], []
+    for track_role in track_roles:
+        preprocess_task = PreprocessTask()
+        encoded_metas.append(preprocess_task.excecute(make_meta(track_role, **kwargs)))
+        input_data.append(preprocess_task.input_data)
+    task = InferenceTask(device)
+    task(model=model, input_data=input_data[0], inference_cfg=inference_cfg)
+    return task, encoded_metas, input_data
@@ -0,0 +1,74 @@
+import torch
+
+from commu.model.model import DecodeMemory
+
+from conftest import MEM_LEN
+
+PREFIX_LEN = 50
+
+
+def random_tokens(qlen, bsz, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(1, 500, (qlen, bsz), generator=generator)
+
+
+def decode(model, mems, tokens):
+    """
+    feed the first PREFIX_LEN tokens as one segment, then the rest one by one, return the logits of every step
+    """
+    logits = []
+    with torch.no_grad():
+        step_logits, mems = model.forward_generate(tokens[:PREFIX_LEN], mems)
+        logits.append(step_logits[-1])
+        for token in tokens[PREFIX_LEN:]:
+            step_logits, mems = model.forward_generate(token[None], mems)
+            logits.append(step_logits[-1])
+    return torch.stack(logits), mems
+
+
+def test_decode_memory_matches_tensor_mems(model):
+    tokens = random_tokens(PREFIX_LEN + 40, 2)
+    expected, _ = decode(model, model.init_mems(model.n_layer), tokens)
+    logits, mems = decode(model, model.init_decode_memory(2), tokens)
+    assert len(mems) == MEM_LEN
+    torch.testing.assert_close(logits, expected)
+
+
+def test_clone_and_cat_past_window(model):
+    # the prefix projects more position heads than mem_len + extra_len positions
+    tokens = random_tokens(PREFIX_LEN + 20, 1)
+    memory = model.init_decode_memory(1)
+    with torch.no_grad():
+        model.forward_generate(tokens[:PREFIX_LEN], memory)
+    assert max(memory.num_pos_heads) > MEM_LEN + memory.extra_len
+
+    clone = memory.clone()
+    compact = memory.clone(capacity=len(memory))
+    batch = DecodeMemory.cat([memory.clone(), compact])
+    assert len(clone) == len(compact) == len(batch) == MEM_LEN
+
+    expected, _ = decode(model, memory, tokens[PREFIX_LEN - 1:])
+    for mems in (clone, compact):
+        logits, _ = decode(model, mems, tokens[PREFIX_LEN - 1:])
+        torch.testing.assert_close(logits, expected)
+    logits, _ = decode(model, batch, tokens[PREFIX_LEN - 1:].expand(-1, 2))
+    torch.testing.assert_close(logits, expected.expand(-1, 2, -1))
+
+
+def test_cached_position_embedding_and_mask(model):
+    for qlen, klen in [(1, 1), (1, MEM_LEN + 5), (PREFIX_LEN, PREFIX_LEN), (3, MEM_LEN + 3), (4, 10)]:
+        like = torch.empty(0)
+        pos_seq = torch.arange(klen - 1, -1, -1.0)
+        torch.testing.assert_close(model.position_embedding(klen, like), model.pos_emb(pos_seq))
+
+        # dec_attn_mask as computed in full by the original _forward
+        mlen = klen - qlen
+        all_ones = torch.ones(qlen, klen)
+        mask_len = klen - model.mem_len
+        mask_shift_len = qlen - mask_len if mask_len > 0 else qlen
+        expected = (torch.triu(all_ones, 1 + mlen) + torch.tril(all_ones, -mask_shift_len)).bool()
+        mask = model.attention_mask(qlen, klen, like.device)
+        if mask is None:
+            assert not expected.any()
+        else:
+            assert torch.equal(mask, expected)
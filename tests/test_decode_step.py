@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+from commu.model.decode_step import load_decode_step, save_decode_step, script_decode_step
+from commu.model.model import DecodeMemory
+
+from conftest import MEM_LEN, make_task
+
+
+@pytest.fixture
+def scripted(model, tmp_path):
+    path = tmp_path / "decode_step.pt"
+    save_decode_step(script_decode_step(model), str(path))
+    return load_decode_step(str(path), torch.device("cpu"))
+
+
+def segments(seed=0):
+    # a prefix longer than mem_len, then segments of 1 to 3 tokens
+    generator = torch.Generator().manual_seed(seed)
+    yield torch.randint(1, 500, (MEM_LEN + 20, 2), generator=generator)
+    for step in range(40):
+        yield torch.randint(1, 500, (1 + step % 3, 2), generator=generator)
+
+
+def test_scripted_logits_match_model(model, scripted):
+    assert model.same_length
+    eager_mems, scripted_mems = model.init_decode_memory(2), scripted.init_decode_memory(2)
+    with torch.no_grad():
+        for tokens in segments():
+            expected, eager_mems = model.forward_generate(tokens, eager_mems)
+            logits, scripted_mems = scripted.forward_generate(tokens, scripted_mems)
+            torch.testing.assert_close(logits, expected)
+            assert (scripted_mems.start, scripted_mems.end) == (eager_mems.start, eager_mems.end)
+            assert scripted_mems.num_pos_heads == eager_mems.num_pos_heads
+    assert len(eager_mems) == MEM_LEN
+
+
+def test_scripted_sequences_match_model(model, scripted, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    track_roles = ["main_melody", "bass"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles)
+    expected = task.execute_batch(encoded_metas, input_data)
+    task, encoded_metas, input_data = make_task(scripted, inference_cfg, track_roles)
+    assert task.execute_batch(encoded_metas, input_data) == expected
+
+
+def test_scripted_rejects_padded_memory(scripted):
+    memories = []
+    with torch.no_grad():
+        for length in (3, 5):
+            memory = scripted.init_decode_memory(1)
+            _, memory = scripted.forward_generate(torch.ones(length, 1, dtype=torch.long), memory)
+            memories.append(memory)
+        padded = DecodeMemory.cat(memories)
+        assert padded.num_pad is not None
+        with pytest.raises(AssertionError):
+            scripted.forward_generate(torch.ones(1, 2, dtype=torch.long), padded)
@@ -0,0 +1,27 @@
+import torch
+
+from commu.midi_generator.container import ModelArguments
+from commu.midi_generator.model_initializer import ModelInitializeTask
+from commu.model.flat_checkpoint import is_flat_checkpoint, write_flat_checkpoint
+
+from conftest import small_training_cfg
+
+
+def test_flat_checkpoint_round_trip(model, tmp_path):
+    path = tmp_path / "checkpoint.flat"
+    write_flat_checkpoint(model.state_dict(), path)
+    assert is_flat_checkpoint(path)
+
+    model_initialize_task = ModelInitializeTask(
+        model_args=ModelArguments(checkpoint_dir=str(path)),
+        map_location="cpu",
+        device=torch.device("cpu"),
+    )
+    loaded = model_initialize_task.initialize_model(small_training_cfg(), path)
+    assert loaded.crit.out_layers[0].weight is loaded.word_emb.emb_layers[0].weight
+
+    tokens = torch.randint(1, 500, (20, 2), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        expected, _ = model.forward_generate(tokens, model.init_decode_memory(2))
+        logits, _ = loaded.forward_generate(tokens, loaded.init_decode_memory(2))
+    assert torch.equal(logits, expected)
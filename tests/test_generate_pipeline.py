@@ -0,0 +1,28 @@
+from commu.midi_generator.generate_pipeline import MidiGenerationPipeline
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+
+from conftest import make_meta
+
+
+def test_stream_bars_match_decoded_sequence(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 200
+    pipeline = MidiGenerationPipeline({"checkpoint_dir": "ckpt/checkpoint_best.pt"})
+    encoded_meta = pipeline.preprocess_task.excecute(make_meta())
+    input_data = pipeline.preprocess_task.input_data
+    pipeline.inference_task(model=model, input_data=input_data, inference_cfg=inference_cfg)
+
+    bars = list(pipeline.stream_bars(encoded_meta))
+    assert len(bars) > 1
+    assert [bar_index for bar_index, _ in bars] == list(range(len(bars)))
+
+    # the same seed gives the same sequence, decoded as a whole
+    sequence, = pipeline.inference_task.execute(encoded_meta)
+    decoded_midi = pipeline.postprocess_task.decode_event_sequence(
+        sequence, pipeline.preprocess_task.get_meta_info_length()
+    )
+    expected = [(note.start, note.end, note.pitch, note.velocity) for note in decoded_midi.instruments[0].notes]
+    notes = [(note.start, note.end, note.pitch, note.velocity) for _, bar_notes in bars for note in bar_notes]
+    assert notes
+    assert notes == expected
@@ -0,0 +1,26 @@
+from commu.midi_generator.generation_pool import get_generation_pool
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+
+from conftest import make_task
+
+
+def test_pool_follows_the_inference_config(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    reseeded = inference_cfg.clone()
+    reseeded.defrost()
+    reseeded.SAMPLING.seed = 1
+    reseeded.freeze()
+
+    pools = []
+    try:
+        for cfg in (inference_cfg, reseeded):
+            task, encoded_metas, input_data = make_task(model, cfg, ["main_melody"])
+            pool = get_generation_pool(model, cfg, num_workers=1, num_threads=1)
+            assert get_generation_pool(model, cfg.clone(), num_workers=1, num_threads=1) is pool
+            pools.append(pool)
+            job = (encoded_metas, input_data, None)
+            assert pool.submit(job).get(timeout=60) == task.execute_batch(encoded_metas, input_data)
+        assert pools[0] is not pools[1]
+    finally:
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,40 @@
+import time
+
+import torch
+
+from commu.midi_generator.generation_worker import GenerationWorker
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+
+from conftest import make_task
+
+
+def test_worker_matches_execute_batch_with_ragged_admission(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    track_roles = ["main_melody", "bass", "pad"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles)
+    expected = [task.execute_batch([meta], [data]) for meta, data in zip(encoded_metas, input_data)]
+
+    worker = GenerationWorker(model, inference_cfg, torch.device("cpu"), max_wait_ms=0)
+    joined = []
+    join = worker.join
+
+    def record_join(states, owners, mems):
+        if worker.mems is not None:
+            joined.append((len(worker.mems), len(mems)))
+        join(states, owners, mems)
+
+    monkeypatch.setattr(worker, "join", record_join)
+    worker.start()
+    try:
+        futures = [worker.submit(encoded_metas[0], input_data[0])]
+        # the other requests join the batch once the first one is past its prefix
+        deadline = time.monotonic() + 10
+        while (worker.mems is None or len(worker.mems) < len(encoded_metas[0]) + 10) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        futures += [worker.submit(meta, data) for meta, data in zip(encoded_metas[1:], input_data[1:])]
+        results = [future.result(timeout=60) for future in futures]
+    finally:
+        worker.stop()
+
+    assert any(batch_len != new_len for batch_len, new_len in joined)
+    assert results == [sequences[0] for sequences in expected]
@@ -0,0 +1,88 @@
+import torch
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+from commu.midi_generator.prefix_cache import get_prefix_cache
+
+from conftest import make_task
+
+
+def test_rolled_back_sequences_stay_in_batch(model, inference_cfg, monkeypatch):
+    # every sequence fails its first validation and is rolled back to its last bar
+    def fail_once(teacher, seq):
+        if not getattr(teacher, "failed", False):
+            teacher.failed = True
+            raise ValueError("injected failure")
+
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", fail_once)
+    model.reset_length(1, 512)
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 200
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody", "bass", "pad"])
+
+    batch_sizes = []
+    forward_generate = model.forward_generate
+
+    def record_batch_size(data, mems):
+        batch_sizes.append(data.size(1))
+        return forward_generate(data, mems)
+
+    monkeypatch.setattr(model, "forward_generate", record_batch_size)
+    batch = task.execute_batch(encoded_metas, input_data)
+    # rolled back sequences go on together with the rest of the batch rather than one by one after it
+    assert batch_sizes.count(1) < len(batch_sizes) // 2
+    alone = [task.execute_batch([meta], [data])[0] for meta, data in zip(encoded_metas, input_data)]
+    assert batch == alone
+
+
+def test_no_rollback_past_memory_window(model, inference_cfg, monkeypatch):
+    # with a memory shorter than the sequence, the positions of the last bar may be gone already
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody"])
+    with torch.no_grad():
+        init_seqs, mems, logits = task.init_seqs_and_mems(encoded_metas, len(encoded_metas[0]))
+        state = task.init_state(init_seqs[0], input_data[0], 0)
+        for _ in task.decode_steps([state], mems, logits, [None]):
+            if len(state.seq) > model.mem_len and state.bar_snapshot is not None:
+                break
+    state.failed = True
+    assert task.roll_back(state) is None
+
+
+def test_prefix_cache_keeps_sequences(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody"])
+    prefix_cache = get_prefix_cache(model, inference_cfg.GENERATION.prefix_cache_bytes)
+    cold = task.execute_batch(encoded_metas, input_data, num_candidates=2)
+    assert (prefix_cache.hits, prefix_cache.misses) == (0, 1)
+    warm = task.execute_batch(encoded_metas, input_data, num_candidates=2)
+    assert prefix_cache.hits == 1
+    assert warm == cold
+
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.prefix_cache_bytes = 0
+    assert task.execute_batch(encoded_metas, input_data, num_candidates=2) == cold
+
+
+def test_prefix_logits_match_peeked_step(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.prefix_cache_bytes = 0
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody"])
+    encoded_meta = encoded_metas[0]
+
+    with torch.no_grad():
+        init_seqs, mems, logits = task.init_seqs_and_mems([encoded_meta], len(encoded_meta))
+        # the original path: the prefix without its last token, then a step on the last token
+        # whose logits were kept and whose memory was thrown away
+        reference_mems = model.init_decode_memory(1)
+        prefix = torch.tensor([0] + encoded_meta[:-1])[:, None]
+        _, reference_mems = model.forward_generate(prefix, reference_mems)
+        peeked_logits, _ = model.forward_generate(torch.tensor([[encoded_meta[-1]]]), reference_mems.clone())
+        reference_logits = peeked_logits[-1, :, 1:]
+        torch.testing.assert_close(logits, reference_logits)
+        assert init_seqs[0] == [0] + encoded_meta
+
+        sequences = task.generate_sequences(init_seqs, mems, logits, input_data)
+        reference = task.generate_sequences([[0] + encoded_meta], reference_mems, reference_logits, input_data)
+    assert sequences[0] is not None
+    assert sequences == reference
@@ -0,0 +1,85 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+
+from conftest import MEM_LEN, make_meta, make_task
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from commu.model.onnx_decode_step import export_onnx_decode_step  # noqa: E402
+from commu.model.onnx_decoder import load_onnx_decode_step  # noqa: E402
+
+# generation in a fresh process, that must not import torch
+DECODE_WITHOUT_TORCH = """
+import json
+import sys
+
+import yacs.config
+
+from commu.midi_generator.info_preprocessor import PreprocessTask
+from commu.midi_generator.midi_inferrer import InferenceTask, TeacherForceTask
+from commu.model.onnx_decoder import load_onnx_decode_step
+
+path, cfg, metas = sys.argv[1:]
+TeacherForceTask.validate_teacher_forced_sequence = lambda teacher, seq: None
+encoded_metas, input_data = [], []
+for meta in json.loads(metas):
+    preprocess_task = PreprocessTask()
+    encoded_metas.append(preprocess_task.excecute(meta))
+    input_data.append(preprocess_task.input_data)
+task = InferenceTask(None)
+task(model=load_onnx_decode_step(path), input_data=input_data[0], inference_cfg=yacs.config.CfgNode.load_cfg(cfg))
+sequences = task.execute_batch(encoded_metas, input_data)
+print(json.dumps({"sequences": sequences, "torch": "torch" in sys.modules}))
+"""
+
+
+@pytest.fixture
+def onnx_path(model, tmp_path):
+    path = tmp_path / "decode_step.onnx"
+    export_onnx_decode_step(model, str(path))
+    return path
+
+
+def segments(seed=0):
+    # a prefix longer than mem_len, then segments of 1 to 3 tokens
+    generator = torch.Generator().manual_seed(seed)
+    yield torch.randint(1, 500, (MEM_LEN + 20, 2), generator=generator)
+    for step in range(40):
+        yield torch.randint(1, 500, (1 + step % 3, 2), generator=generator)
+
+
+def test_onnx_logits_match_model(model, onnx_path):
+    decoder = load_onnx_decode_step(str(onnx_path))
+    eager_mems, onnx_mems = model.init_decode_memory(2), decoder.init_decode_memory(2)
+    with torch.no_grad():
+        for tokens in segments():
+            expected, eager_mems = model.forward_generate(tokens, eager_mems)
+            logits, onnx_mems = decoder.forward_generate(tokens.numpy(), onnx_mems)
+            np.testing.assert_allclose(logits, expected.numpy(), rtol=1e-4, atol=1e-5)
+            assert (onnx_mems.start, onnx_mems.end) == (eager_mems.start, eager_mems.end)
+    assert len(onnx_mems) == MEM_LEN
+
+
+def test_onnx_sequences_match_model_without_torch(model, onnx_path, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    track_roles = ["main_melody", "bass"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles)
+    expected = task.execute_batch(encoded_metas, input_data)
+
+    metas = [make_meta(track_role) for track_role in track_roles]
+    output = subprocess.run(
+        [sys.executable, "-c", DECODE_WITHOUT_TORCH, str(onnx_path), inference_cfg.dump(), json.dumps(metas)],
+        cwd=Path(__file__).parents[1], capture_output=True, text=True, check=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    assert not result["torch"]
+    assert result["sequences"] == expected
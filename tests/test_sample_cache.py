@@ -0,0 +1,76 @@
+import pytest
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+from commu.midi_generator.sample_cache import SampleCache, sample_key
+
+from conftest import make_task
+
+
+def test_get_and_put(tmp_path):
+    cache = SampleCache(str(tmp_path / "samples.db"), max_bytes=1024)
+    assert cache.get("a") is None
+    cache.put("a", [[1, 2, 3], [4, 5]])
+    assert cache.get("a") == [[1, 2, 3], [4, 5]]
+    cache.put("a", [[6]])
+    assert cache.get("a") == [[6]]
+    assert (len(cache), cache.hits, cache.misses) == (1, 2, 1)
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    sequences = [list(range(30))]
+    cache = SampleCache(str(tmp_path / "samples.db"), max_bytes=300)
+    for key in "abc":
+        cache.put(key, sequences)
+    assert cache.num_bytes <= 300
+    cache.get("a")
+    cache.put("d", sequences)
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("d") == sequences
+    # too large to be cached at all
+    cache.put("e", [list(range(300))])
+    assert cache.get("e") is None and len(cache) == 3
+
+
+@pytest.mark.parametrize("section, name, value", [
+    ("SAMPLING", "seed", 1),
+    ("SAMPLING", "pitch_margin", 3),
+    ("GENERATION", "generation_length", 81),
+    ("GENERATION", "max_rollbacks", 5),
+])
+def test_sample_key_changes_with_the_config(model, inference_cfg, section, name, value):
+    _, _, input_data = make_task(model, inference_cfg, ["main_melody"])
+    key = sample_key(input_data[0], inference_cfg, 1, "model")
+    changed = inference_cfg.clone()
+    changed.defrost()
+    setattr(changed[section], name, value)
+    assert sample_key(input_data[0], changed, 1, "model") != key
+
+
+def test_sample_key_changes_with_the_inputs(model, inference_cfg):
+    _, _, input_data = make_task(model, inference_cfg, ["main_melody", "bass"])
+    key = sample_key(input_data[0], inference_cfg, 1, "model")
+    assert sample_key(input_data[1], inference_cfg, 1, "model") != key
+    assert sample_key(input_data[0], inference_cfg, 2, "model") != key
+    assert sample_key(input_data[0], inference_cfg, 1, "other model") != key
+    assert sample_key(input_data[0].copy(update={"top_k": 8}), inference_cfg, 1, "model") != key
+    # the output directory does not change the sequences
+    assert sample_key(input_data[0].copy(update={"output_dir": "elsewhere"}), inference_cfg, 1, "model") == key
+
+
+def test_short_entries_are_generated_again_and_written_back(model, inference_cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody"])
+    input_data = [input_data[0].copy(update={"num_generate": 3})]
+    expected = task.execute_batch(encoded_metas, input_data)
+
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.sample_cache_path = str(tmp_path / "samples.db")
+    cache = task.sample_cache()
+    key = task.sample_key(input_data[0], inference_cfg.GENERATION.num_candidates)
+    cache.put(key, expected[0][:1])
+    assert task.execute_batch(encoded_metas, input_data) == expected
+    assert cache.get(key) == expected[0]
+    # replayed from the cache
+    misses = cache.misses
+    assert task.execute_batch(encoded_metas, input_data) == expected
+    assert cache.misses == misses
@@ -0,0 +1,28 @@
+import mido
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+from commu.midi_generator.sequence_postprocessor import PostprocessTask
+
+from conftest import make_task
+
+
+def test_in_memory_midis_match_dumped_files(model, inference_cfg, monkeypatch, tmp_path):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    model.reset_length(1, 512)
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 300
+    track_roles = ["main_melody", "bass", "pad"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles)
+    sequences = [sequence for sequences in task.execute_batch(encoded_metas, input_data) for sequence in sequences]
+
+    postprocess_task = PostprocessTask()
+    midis = postprocess_task.execute_in_memory(sequences=sequences, meta_info_len=len(encoded_metas[0]))
+    for idx, (sequence, midi) in enumerate(zip(sequences, midis)):
+        # the previous path: written by miditoolkit, then read back with mido
+        path = tmp_path / f"{idx}.mid"
+        postprocess_task.decode_event_sequence(sequence, len(encoded_metas[0])).dump(path)
+        expected = mido.MidiFile(path)
+        assert midi.ticks_per_beat == expected.ticks_per_beat
+        assert len(midi.tracks) == len(expected.tracks)
+        for track, expected_track in zip(midi.tracks, expected.tracks):
+            assert list(track) == list(expected_track)
@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from commu.midi_generator.midi_inferrer import TeacherForceTask
+from commu.midi_generator.token_grammar import TOKEN_RANGES, GrammarState, TokenGrammar
+from commu.preprocessor.encoder import encoder_utils
+from commu.preprocessor.utils import constants
+
+from conftest import make_task
+
+
+def test_generated_tokens_follow_grammar(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    model.reset_length(1, 512)
+    inference_cfg.defrost()
+    inference_cfg.GENERATION.generation_length = 300
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody", "bass", "pad", "riff"])
+    grammar = TokenGrammar(torch.device("cpu"))
+
+    for sequence, in task.execute_batch(encoded_metas, input_data):
+        states = [grammar.state(token) for token in sequence]
+        assert GrammarState.PITCH in states
+        # the first generated token follows the last meta token
+        for idx in range(len(encoded_metas[0]) + 1, len(sequence)):
+            # chords are teacher forced, never sampled
+            if states[idx] == GrammarState.CHORD:
+                continue
+            assert grammar.allowed_tokens(sequence[idx - 1])[sequence[idx]], (idx, sequence[idx - 1:idx + 1])
+
+
+def test_meta_constraints_keep_pitches_and_velocities_in_range(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    track_roles = ["main_melody", "bass", "pad", "riff"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles, meta_constraints=True)
+    data = input_data[0]
+    cuts = list(constants.PITCH_RANGE_CUT.values())
+    idx = list(constants.PITCH_RANGE_CUT).index(data.pitch_range)
+    margin = inference_cfg.SAMPLING.pitch_margin
+    low_pitch, high_pitch = cuts[idx - 1] - margin, cuts[idx] - 1 + margin
+    # bins overlapping [min_velocity, max_velocity]
+    bins = list(encoder_utils.DEFAULT_VELOCITY_BINS) + [128]
+    velocity_bins = [
+        b for b in range(len(bins) - 1) if bins[b] <= data.max_velocity and bins[b + 1] > data.min_velocity
+    ]
+    pitches, velocities = TOKEN_RANGES[GrammarState.PITCH], TOKEN_RANGES[GrammarState.NOTE_VELOCITY]
+
+    num_notes = 0
+    for sequence, in task.execute_batch(encoded_metas, input_data):
+        for token in sequence[len(encoded_metas[0]) + 1:]:
+            if token in pitches:
+                assert low_pitch <= token - pitches.start <= high_pitch
+                num_notes += 1
+            elif token in velocities:
+                assert token - velocities.start in velocity_bins
+    assert num_notes > 0
+
+
+def test_meta_constraints_off_leave_sampling_unchanged(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    track_roles = ["main_melody", "bass"]
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles)
+    monkeypatch.setattr(task.grammar, "meta_mask", lambda *args: pytest.fail("meta mask built without constraints"))
+    expected = task.execute_batch(encoded_metas, input_data)
+
+    # a mask allowing every token goes through the masked path without changing the samples
+    task, encoded_metas, input_data = make_task(model, inference_cfg, track_roles, meta_constraints=True)
+    monkeypatch.setattr(task.grammar, "meta_mask", lambda *args: task.grammar.all_tokens)
+    assert task.execute_batch(encoded_metas, input_data) == expected
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import torch
+
+from commu.midi_generator.midi_inferrer import InferenceTask, SequenceState, TeacherForceTask
+from commu.midi_generator.numpy_token_sampler import NumpyTokenSampler
+from commu.midi_generator.token_sampler import TokenSampler
+
+from conftest import make_task
+
+VOCAB_SIZE = 50
+SAMPLERS = {
+    "torch": lambda: TokenSampler(VOCAB_SIZE, torch.device("cpu")),
+    "numpy": lambda: NumpyTokenSampler(VOCAB_SIZE),
+}
+
+
+def random_batch(bsz, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(bsz, VOCAB_SIZE, generator=generator) * 3
+    allowed = torch.rand(bsz, VOCAB_SIZE, generator=generator) < 0.5
+    return logits, allowed
+
+
+def sample(name, sampler, logits, allowed, temperatures, top_ks, seeds=None, generators=None):
+    if seeds is not None:
+        generators = [sampler.generator(seed) for seed in seeds]
+    if name == "numpy":
+        logits, allowed = logits.numpy(), allowed.numpy()
+    return sampler.sample(logits, allowed, temperatures, top_ks, generators)
+
+
+@pytest.mark.parametrize("name", SAMPLERS)
+def test_seeded_draws_do_not_depend_on_the_batch(name):
+    sampler = SAMPLERS[name]()
+    logits, allowed = random_batch(4)
+    alone, batched = sampler.generator(7), [sampler.generator(seed) for seed in (1, 7, 2, 3)]
+    for _ in range(20):
+        token = sample(name, sampler, logits[1:2], allowed[1:2], [1.0], [10], generators=[alone])
+        tokens = sample(name, sampler, logits, allowed, [0.5, 1.0, 0.0, 2.0], [5, 10, 1, 50], generators=batched)
+        assert tokens[1] == token[0]
+
+
+def test_numpy_sampler_matches_torch_sampler():
+    logits, allowed = random_batch(8)
+    temperatures, top_ks = [0.5, 1.0, 0.0, 2.0] * 2, [5, 10, 1, 50, 3, 50, 20, 1]
+    samplers = {name: make() for name, make in SAMPLERS.items()}
+    for seed in range(10):
+        seeds = [seed * 8 + idx for idx in range(8)]
+        expected = sample("torch", samplers["torch"], logits, allowed, temperatures, top_ks, seeds)
+        assert sample("numpy", samplers["numpy"], logits, allowed, temperatures, top_ks, seeds) == expected
+
+
+@pytest.mark.parametrize("name", SAMPLERS)
+def test_samples_follow_top_k_and_mask(name):
+    sampler = SAMPLERS[name]()
+    logits, allowed = random_batch(3)
+    top_ks = [1, 4, 10]
+    for seed in range(50):
+        tokens = sample(name, sampler, logits, allowed, [2.0] * 3, top_ks, [seed, seed + 100, seed + 200])
+        for row, (token, top_k) in enumerate(zip(tokens, top_ks)):
+            candidates = logits[row].masked_fill(~allowed[row], -float("inf")).topk(top_k).indices + 1
+            assert token in candidates.tolist()
+
+
+@pytest.mark.parametrize("name", SAMPLERS)
+def test_mixed_temperatures_and_argmax(name):
+    sampler = SAMPLERS[name]()
+    logits, allowed = random_batch(4)
+    masked = logits.masked_fill(~allowed, -float("inf"))
+    temperatures, top_ks = [0.0, 1.0, 0.0, 0.3], [VOCAB_SIZE] * 4
+    for seed in range(20):
+        tokens = sample(name, sampler, logits, allowed, temperatures, top_ks, [seed] * 4)
+        assert tokens[0] == masked[0].argmax().item() + 1
+        assert tokens[2] == masked[2].argmax().item() + 1
+        assert allowed[1, tokens[1] - 1] and allowed[3, tokens[3] - 1]
+
+
+@pytest.mark.parametrize("name", SAMPLERS)
+def test_fully_masked_row_fails_the_sequence(name, model, inference_cfg):
+    sampler = SAMPLERS[name]()
+    logits, allowed = random_batch(2)
+    allowed[1] = False
+    tokens = sample(name, sampler, logits, allowed, [1.0, 1.0], [10, 10], [0, 1])
+    assert tokens[0] != 0 and tokens[1] == 0
+
+    task, _, input_data = make_task(model, inference_cfg, ["main_melody"])
+    state = SequenceState([0], input_data[0])
+    task.accept_sampled_token(state, tokens[1])
+    assert state.failed and state.seq == [0]
+
+
+def test_seeded_sequence_does_not_depend_on_the_batch(model, inference_cfg, monkeypatch):
+    monkeypatch.setattr(TeacherForceTask, "validate_teacher_forced_sequence", lambda teacher, seq: None)
+    task, encoded_metas, input_data = make_task(model, inference_cfg, ["main_melody", "bass", "pad"])
+    batched = task.execute_batch(encoded_metas, input_data, num_candidates=2)
+    for idx in range(len(encoded_metas)):
+        assert task.execute_batch([encoded_metas[idx]], [input_data[idx]], num_candidates=2)[0] == batched[idx]
+
+
+def test_inference_task_without_device_samples_on_numpy():
+    task = InferenceTask(None)
+    assert isinstance(task.sampler, NumpyTokenSampler)
+    assert isinstance(task.grammar.masks, np.ndarray)
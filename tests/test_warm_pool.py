@@ -0,0 +1,84 @@
+import importlib
+import sys
+import time
+import types
+
+import pytest
+
+from commu.midi_generator.warm_pool import WarmPool, combination_key, parse_combination_key
+
+COMBINATION = combination_key(120, "aminor", "4/4", 8, "newage", "standard", "Am-C-G-D")
+ROLES = ["main_melody", "bass", "pad"]
+
+
+@pytest.fixture
+def warm_pool(tmp_path):
+    return WarmPool(str(tmp_path / "warm_pool.sqlite3"))
+
+
+@pytest.fixture
+def pregenerate(monkeypatch):
+    """
+    pregenerate.py, with a DSET that only knows the track roles: refilling does not read the dataset
+    """
+    commu_dset = types.ModuleType("commu_dset")
+    commu_dset.DSET = types.SimpleNamespace(get_track_roles=lambda: list(ROLES))
+    monkeypatch.setitem(sys.modules, "commu_dset", commu_dset)
+    for name in ("pregenerate", "commu_wrapper"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    return importlib.import_module("pregenerate")
+
+
+def test_combination_key_round_trip():
+    assert parse_combination_key(COMBINATION) == (120, "aminor", "4/4", 8, "newage", "standard", "Am-C-G-D")
+
+
+def test_take_removes_samples(warm_pool):
+    assert warm_pool.take(COMBINATION, "bass") is None
+    warm_pool.add(COMBINATION, "bass", "electric_bass", [1, 2, 700])
+    warm_pool.add(COMBINATION, "bass", "electric_bass", [3, 4])
+    warm_pool.add(COMBINATION, "pad", "string_ensemble", [5])
+    assert (warm_pool.count(COMBINATION, "bass"), warm_pool.count(COMBINATION, "pad"), len(warm_pool)) == (2, 1, 3)
+
+    taken = [warm_pool.take(COMBINATION, "bass") for _ in range(2)]
+    assert sorted(taken) == [("electric_bass", [1, 2, 700]), ("electric_bass", [3, 4])]
+    assert warm_pool.take(COMBINATION, "bass") is None
+    assert warm_pool.count(COMBINATION, "bass") == 0 and len(warm_pool) == 1
+
+
+def test_requested_combinations(warm_pool):
+    other = combination_key(90, "cmajor", "3/4", 4, "cinematic", "swing", "C-F")
+    warm_pool.record_request(COMBINATION)
+    since = time.time()
+    time.sleep(0.01)
+    for _ in range(2):
+        warm_pool.record_request(other)
+    assert warm_pool.requested_combinations() == [other, COMBINATION]
+    assert warm_pool.requested_combinations(since=since) == [other]
+    assert warm_pool.requested_combinations(since=time.time()) == []
+
+
+def test_refill_tops_up_roles_below_the_low_watermark(pregenerate, warm_pool, monkeypatch):
+    calls = []
+
+    def encode_role(cfg, role, *args):
+        return None, f"{role}_instrument", [len(calls)]
+
+    def generate_sequences(cfg, pipelines, encoded_metas, seed=None):
+        calls.append((len(encoded_metas), seed))
+        return [[[meta[0], idx]] for idx, meta in enumerate(encoded_metas)]
+
+    monkeypatch.setattr(pregenerate, "encode_role", encode_role)
+    monkeypatch.setattr(pregenerate, "generate_sequences", generate_sequences)
+    for _ in range(3):
+        warm_pool.add(COMBINATION, "main_melody", "acoustic_piano", [1])
+    warm_pool.add(COMBINATION, "bass", "electric_bass", [1])
+
+    # main_melody is at the watermark, bass and pad are below it
+    assert pregenerate.refill({}, warm_pool, COMBINATION, samples_per_role=4, low_watermark=3) == 3 + 4
+    # every sample is a new draw, whatever SAMPLING.seed
+    assert calls == [(7, -1)]
+    assert [warm_pool.count(COMBINATION, role) for role in ROLES] == [3, 4, 4]
+
+    assert pregenerate.refill({}, warm_pool, COMBINATION, samples_per_role=4, low_watermark=3) == 0
+    assert len(calls) == 1